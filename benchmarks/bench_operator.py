@@ -0,0 +1,244 @@
+"""Throughput benchmark for the operator (``opr/operator.py``).
+
+Runs the kopf handlers of the operator against the in-process fake Kubernetes API server from
+``tests/fake_apiserver.py`` instead of a cluster. Objects are dispatched to the handlers the way kopf does it: the
+indices are updated first and at most ``--workers`` handlers run at the same time. Reports events/sec, API calls per
+event, the time until all config maps hold the expected values and memory as JSON::
+
+    python -m benchmarks.bench_operator --key-value-pairs 100,1000,10000 --config-servers 1,10 --latency 0.002
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+import time
+from pathlib import Path
+
+import kubernetes_asyncio
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from benchmarks.bench_server import rss_bytes
+from opr import operator
+from tests.fake_apiserver import FakeCluster, make_fake_apiserver
+
+NAMESPACE = "bench"
+GROUP_VERSION = "apis/datalab.tuwien.ac.at/v1"
+
+logger = logging.getLogger("bench_operator")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='Operator Benchmark', description=__doc__.splitlines()[0])
+    parser.add_argument('--key-value-pairs', default='100,1000,10000', type=_int_list,
+                        help='comma separated numbers of KeyValuePairs, spread evenly over the config servers')
+    parser.add_argument('--config-servers', default='1,10', type=_int_list,
+                        help='comma separated numbers of ConfigServers')
+    parser.add_argument('--shards', default=1, type=int, help='config map shards per config server')
+    parser.add_argument('--value-size', default=100, type=int, help='approximate size of a single value in bytes')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='seconds every request to the fake API server is delayed')
+    parser.add_argument('--workers', default=operator.MAX_WORKERS, type=int,
+                        help='number of handlers that run at the same time (like kopf\'s worker limit)')
+    parser.add_argument('--batch-window', default=operator.BATCH_WINDOW, type=float,
+                        help='seconds changes of the same config map are collected into one patch')
+    parser.add_argument('-o', '--output', default=None, type=str, help='file the JSON results are written to')
+    return parser
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',') if v]
+
+
+class OperatorHarness:
+    """Feeds objects of a :class:`FakeCluster` to the operator's handlers and keeps the kopf indices up to date."""
+
+    def __init__(self, cluster: FakeCluster, workers: int):
+        self.cluster = cluster
+        self.workers = asyncio.Semaphore(workers)
+        self.key_value_index: dict[tuple[str, str], dict[str, tuple[str, str]]] = {}
+        self.config_server_index: dict[tuple[str, str], list[dict]] = {}
+
+    def indices(self) -> dict:
+        # kopf passes each index as a mapping of index keys to the collection of values of all indexed objects
+        return {"key_value_index": {key: list(values.values()) for key, values in self.key_value_index.items()},
+                "config_server_index": self.config_server_index}
+
+    async def index(self, plural: str, obj: dict, deleted: bool = False):
+        meta, spec = obj["metadata"], obj["spec"]
+        if plural == "configservers":
+            for key, value in (await operator.config_server_index(namespace=NAMESPACE, name=meta["name"],
+                                                                  spec=spec)).items():
+                self.config_server_index[key] = [value]
+        else:
+            entry = None if deleted else await operator.key_value_index(namespace=NAMESPACE, meta=meta, spec=spec)
+            for values in self.key_value_index.values():
+                values.pop(meta["name"], None)
+            for key, value in (entry or {}).items():
+                self.key_value_index.setdefault(key, {})[meta["name"]] = value
+
+    async def dispatch(self, handler, plural: str, obj: dict, deleted: bool = False, **kwargs):
+        await self.index(plural, obj, deleted)
+        async with self.workers:
+            await handler(meta=obj["metadata"], spec=obj["spec"], logger=logger, **self.indices(), **kwargs)
+
+    async def run(self, handler, plural: str, objects: list[dict], deleted: bool = False) -> float:
+        """Store the objects in the fake cluster, run the handler for all of them and return the seconds it took."""
+        started = time.perf_counter()
+        for obj in objects:
+            if deleted:
+                self.cluster.remove(GROUP_VERSION, NAMESPACE, plural, obj["metadata"]["name"])
+            else:
+                self.cluster.put(GROUP_VERSION, NAMESPACE, plural, obj)
+        await asyncio.gather(*(self.dispatch(handler, plural, obj, deleted) for obj in objects))
+        return time.perf_counter() - started
+
+
+def config_server(name: str, shards: int) -> dict:
+    return {"apiVersion": "datalab.tuwien.ac.at/v1", "kind": "ConfigServer",
+            "metadata": {"name": name, "namespace": NAMESPACE},
+            "spec": {"image": "ghcr.io/tu-wien-datalab/config-server:main", "imagePullPolicy": "IfNotPresent",
+                     "containerPort": 80, "configMountPath": "/var/lib/config-server", "shards": shards}}
+
+
+def key_value_pair(i: int, config: str, value_size: int, revision: int = 0) -> dict:
+    value = {"id": i, "revision": revision, "payload": ""}
+    value["payload"] = "x" * max(value_size - len(json.dumps(value)), 0)
+    return {"apiVersion": "datalab.tuwien.ac.at/v1", "kind": "KeyValuePair",
+            "metadata": {"name": f"kvp-{i}", "namespace": NAMESPACE},
+            "spec": {"config": config, "key": f"key-{i}", "value": value}}
+
+
+def converged(cluster: FakeCluster, servers: list[dict], pairs: list[dict]) -> bool:
+    """Whether the config maps hold exactly the values of the given KeyValuePairs."""
+    expected = {server["metadata"]["name"]: {} for server in servers}
+    for pair in pairs:
+        expected[pair["spec"]["config"]][pair["spec"]["key"]] = json.dumps(pair["spec"]["value"])
+    config_maps = cluster.collection("api/v1", NAMESPACE, "configmaps")
+    for server in servers:
+        data = {}
+        for name in operator.shard_config_maps(server["metadata"]["name"], server["spec"]):
+            data.update(config_maps.get(name, {}).get("data") or {})
+        if data != expected[server["metadata"]["name"]]:
+            return False
+    return True
+
+
+async def measure(harness: OperatorHarness, name: str, handler, plural: str, objects: list[dict],
+                  servers: list[dict], expected: list[dict], deleted: bool = False) -> dict:
+    requests_before = dict(harness.cluster.requests)
+    seconds = await harness.run(handler, plural, objects, deleted)
+    api_calls = {verb: count - requests_before.get(verb, 0) for verb, count in harness.cluster.requests.items()
+                 if count - requests_before.get(verb, 0)}
+    if not converged(harness.cluster, servers, expected):
+        raise AssertionError(f"config maps did not converge after '{name}'")
+    events = max(len(objects), 1)
+    return {
+        "events": len(objects),
+        "events_per_second": len(objects) / seconds if seconds else 0.0,
+        # all handlers only return once their change is stored, so this is also the convergence time
+        "convergence_seconds": seconds,
+        "api_calls": api_calls,
+        "api_calls_per_event": sum(api_calls.values()) / events,
+    }
+
+
+async def benchmark(key_value_pairs: int, config_servers: int, value_size: int = 100, shards: int = 1,
+                    latency: float = 0.0, workers: int = operator.MAX_WORKERS,
+                    batch_window: float = operator.BATCH_WINDOW) -> dict:
+    cluster = FakeCluster(history=10 * (key_value_pairs + config_servers) + 100, latency=latency)
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(make_fake_apiserver(cluster))
+    server.add_sockets(sockets)
+
+    configuration = kubernetes_asyncio.client.Configuration(host=f"http://127.0.0.1:{sockets[0].getsockname()[1]}")
+    configuration.connection_pool_maxsize = operator.API_POOL_SIZE
+    client = kubernetes_asyncio.client.ApiClient(configuration=configuration)
+    previous_client, operator._api_client = operator._api_client, client
+    previous_writes, operator.config_map_writes = operator.config_map_writes, operator.ConfigMapWriteBatcher(
+        window=batch_window)
+    previous_hashes, operator.content_hashes = operator.content_hashes, operator.ContentHashes()
+    harness = OperatorHarness(cluster, workers)
+
+    servers = [config_server(f"server-{i}", shards) for i in range(config_servers)]
+    pairs = [key_value_pair(i, f"server-{i % config_servers}", value_size) for i in range(key_value_pairs)]
+    updated = [key_value_pair(i, f"server-{i % config_servers}", value_size, revision=1)
+               for i in range(key_value_pairs)]
+    rss_before = rss_bytes()
+    try:
+        results = {
+            "create_config_servers": await measure(harness, "create_config_servers", operator.create_fn,
+                                                   "configservers", servers, servers, []),
+            "create_key_value_pairs": await measure(harness, "create_key_value_pairs", operator.create_config_fn,
+                                                    "keyvaluepairs", pairs, servers, pairs),
+            "update_key_value_pairs": await measure(harness, "update_key_value_pairs", operator.create_config_fn,
+                                                    "keyvaluepairs", updated, servers, updated),
+            # unchanged values are recognized by their content hash and not written again
+            "noop_update_key_value_pairs": await measure(harness, "noop_update_key_value_pairs",
+                                                         operator.create_config_fn, "keyvaluepairs", updated,
+                                                         servers, updated),
+        }
+        rss_loaded = rss_bytes()
+        results["delete_key_value_pairs"] = await measure(harness, "delete_key_value_pairs",
+                                                          operator.delete_config_fn, "keyvaluepairs", updated,
+                                                          servers, [], deleted=True)
+    finally:
+        await client.close()
+        server.stop()
+        operator._api_client = previous_client
+        operator.config_map_writes = previous_writes
+        operator.content_hashes = previous_hashes
+
+    config_map_bytes = sum(len(json.dumps(obj))
+                           for obj in cluster.collection("api/v1", NAMESPACE, "configmaps").values())
+    return {
+        "key_value_pairs": key_value_pairs,
+        "config_servers": config_servers,
+        "shards": shards,
+        "value_size": value_size,
+        "latency": latency,
+        "rss_before_bytes": rss_before,
+        "rss_loaded_bytes": rss_loaded,
+        "rss_after_bytes": rss_bytes(),
+        "config_map_bytes": config_map_bytes,
+        "scenarios": results,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    runs = []
+    for config_servers in args.config_servers:
+        for key_value_pairs in args.key_value_pairs:
+            result = await benchmark(key_value_pairs, config_servers, args.value_size, args.shards, args.latency,
+                                     args.workers, args.batch_window)
+            for name, scenario in result["scenarios"].items():
+                print(f"{config_servers:>4} servers {key_value_pairs:>6} pairs  {name:<28} "
+                      f"{scenario['events_per_second']:>9.1f} events/s  "
+                      f"{scenario['api_calls_per_event']:>6.3f} calls/event  "
+                      f"{scenario['convergence_seconds']:>7.2f} s", file=sys.stderr)
+            runs.append(result)
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": args.workers,
+        "batch_window": args.batch_window,
+        "runs": runs,
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    args = get_parser().parse_args()
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Load test and micro-benchmarks for the config server (``srv/server.py``).
+
+Builds synthetic config directories, serves them in-process with the application from ``make_app`` and drives it
+with Tornado's async HTTP client. Results are written as JSON so they can be compared between releases::
+
+    python -m benchmarks.bench_server --keys 10,1000,50000 --value-sizes 100,10000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from srv.server import make_app
+
+TEAMS = 10
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='Config Server Benchmark', description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', default='10,1000,10000', type=_int_list,
+                        help='comma separated numbers of keys of the synthetic config directories')
+    parser.add_argument('--value-sizes', default='100,10000', type=_int_list,
+                        help='comma separated approximate sizes of a single value in bytes (up to ~1 MiB)')
+    parser.add_argument('--requests', default=500, type=int, help='number of requests per scenario')
+    parser.add_argument('--concurrency', default=16, type=int, help='number of concurrent requests')
+    parser.add_argument('--max-config-bytes', default=512 * 1024 * 1024, type=int,
+                        help='skip combinations whose total config size exceeds this number of bytes')
+    parser.add_argument('-o', '--output', default=None, type=str, help='file the JSON results are written to')
+    return parser
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',') if v]
+
+
+def build_config_dir(directory: Path, keys: int, value_size: int):
+    """Write ``keys`` JSON values of roughly ``value_size`` bytes each, like a mounted config map."""
+    for i in range(keys):
+        value = {"id": i, "team": f"team-{i % TEAMS}", "db": {"pool": {"size": i % 32}}, "payload": ""}
+        value["payload"] = "x" * max(value_size - len(json.dumps(value)), 0)
+        (directory / f"key-{i}").write_text(json.dumps(value))
+
+
+def rss_bytes() -> int:
+    """Current resident set size, falls back to the peak RSS where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+async def run_scenario(client: AsyncHTTPClient, base_url: str, requests: list[dict], concurrency: int) -> dict:
+    latencies, errors, received = [], 0, 0
+    queue = list(reversed(requests))
+
+    async def worker():
+        nonlocal errors, received
+        while queue:
+            request = queue.pop()
+            started = time.perf_counter()
+            try:
+                response = await client.fetch(base_url + request["path"], method=request.get("method", "GET"),
+                                              body=request.get("body"), request_timeout=120)
+                received += len(response.body)
+            except HTTPClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+        "bytes_received": received,
+    }
+
+
+def scenarios(keys: int, requests: int) -> dict[str, list[dict]]:
+    rng = random.Random(keys)
+    return {
+        "get": [{"path": f"/config/key-{rng.randrange(keys)}"} for _ in range(requests)],
+        "get_sub_path": [{"path": f"/config/key-{rng.randrange(keys)}/db/pool/size"} for _ in range(requests)],
+        "batch_get_10": [{"path": "/config?keys=" + ",".join(f"key-{rng.randrange(keys)}" for _ in range(10))}
+                         for _ in range(requests)],
+        # distinct queries defeat the result cache, repeated ones measure it
+        "query_uncached": [{"path": "/config", "method": "POST",
+                            "body": json.dumps({"query": f"team == 'team-{i % TEAMS}' && id > `{i}`"})}
+                           for i in range(max(requests // 10, 1))],
+        "query_cached": [{"path": "/config", "method": "POST", "body": json.dumps({"query": "db.pool.size"})}
+                         for _ in range(requests)],
+    }
+
+
+async def benchmark(keys: int, value_size: int, requests: int, concurrency: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        build_config_dir(directory, keys, value_size)
+
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        app = make_app(directory, reload_interval=1.0)
+        load_seconds = time.perf_counter() - started
+        rss_loaded = rss_bytes()
+
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+        base_url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+        client = AsyncHTTPClient(force_instance=True, max_clients=concurrency, max_body_size=1024 ** 3)
+        try:
+            results = {name: await run_scenario(client, base_url, reqs, concurrency)
+                       for name, reqs in scenarios(keys, requests).items()}
+        finally:
+            client.close()
+            server.stop()
+            app.settings['executor'].shutdown(wait=False)
+
+        return {
+            "keys": keys,
+            "value_size": value_size,
+            "snapshot_load_seconds": load_seconds,
+            "rss_before_bytes": rss_before,
+            "rss_loaded_bytes": rss_loaded,
+            "rss_after_bytes": rss_bytes(),
+            "scenarios": results,
+        }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    runs = []
+    for keys in args.keys:
+        for value_size in args.value_sizes:
+            if keys * value_size > args.max_config_bytes:
+                print(f"skipping {keys} keys x {value_size} bytes: exceeds --max-config-bytes", file=sys.stderr)
+                continue
+            result = await benchmark(keys, value_size, args.requests, args.concurrency)
+            for name, scenario in result["scenarios"].items():
+                print(f"{keys:>6} keys {value_size:>8} B  {name:<15} {scenario['throughput_rps']:>9.1f} req/s  "
+                      f"p50 {scenario['p50_ms']:>8.2f} ms  p99 {scenario['p99_ms']:>8.2f} ms", file=sys.stderr)
+            runs.append(result)
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "runs": runs,
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
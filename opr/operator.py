@@ -1,58 +1,228 @@
+import asyncio
+import base64
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
+import struct
+import time
+import zlib
 
 import kopf
-import kubernetes
-from kubernetes.client import ApiClient, CoreV1Api, AppsV1Api, CustomObjectsApi, V1ConfigMap, V1Service
+import kubernetes_asyncio
+import prometheus_client
+from kubernetes_asyncio.client import ApiClient, CoreV1Api, AppsV1Api, AutoscalingV2Api, PolicyV1Api, \
+    RbacAuthorizationV1Api, V1ConfigMap
 
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
 
-def load_kubernetes_config():
+# number of attempts to patch a config map when its resourceVersion changed in the meantime
+PATCH_RETRIES = int(os.environ.get('CONFIG_SERVER_PATCH_RETRIES', '5'))
+PATCH_RETRY_BACKOFF = float(os.environ.get('CONFIG_SERVER_PATCH_RETRY_BACKOFF', '0.1'))
+# key/value changes of the same config map within this window (seconds) or up to this number are written together
+BATCH_WINDOW = float(os.environ.get('CONFIG_SERVER_BATCH_WINDOW', '0.2'))
+BATCH_SIZE = int(os.environ.get('CONFIG_SERVER_BATCH_SIZE', '100'))
+# number of objects that are handled concurrently; handlers wait for their batch to be written, so enough of them
+# have to run at the same time to fill a batch
+MAX_WORKERS = int(os.environ.get('CONFIG_SERVER_MAX_WORKERS', '256'))
+# connections to the API server, this also limits the number of concurrent API calls; further calls wait for a
+# free connection
+API_POOL_SIZE = int(os.environ.get('CONFIG_SERVER_API_POOL_SIZE', '32'))
+# interval (seconds) in which the config maps are compared with the key/value pairs and repaired if they drifted
+RECONCILE_INTERVAL = float(os.environ.get('CONFIG_SERVER_RECONCILE_INTERVAL', '300'))
+# refresh the (bound) service account token before it expires
+API_TOKEN_REFRESH = os.environ.get('CONFIG_SERVER_API_TOKEN_REFRESH', 'true').lower() in ('1', 'true', 'yes')
+# port of the Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = int(os.environ.get('CONFIG_SERVER_METRICS_PORT', '9090'))
+
+# kopf loads this file as a new module for every run, so the metrics live in a registry of the module instead of
+# the global one of prometheus_client, where they could only be registered once per process
+REGISTRY = prometheus_client.CollectorRegistry()
+HANDLER_DURATION = prometheus_client.Histogram(
+    'config_operator_handler_duration_seconds',
+    'Time from the start of a handler until it returned, including the wait for batched writes',
+    ['handler'], registry=REGISTRY)
+HANDLER_ERRORS = prometheus_client.Counter(
+    'config_operator_handler_errors_total', 'Handler invocations that raised an error (and are retried by kopf)',
+    ['handler'], registry=REGISTRY)
+API_REQUESTS = prometheus_client.Counter(
+    'config_operator_api_requests_total', 'Requests to the Kubernetes API server', ['verb', 'code'], registry=REGISTRY)
+API_DURATION = prometheus_client.Histogram(
+    'config_operator_api_request_duration_seconds', 'Latency of requests to the Kubernetes API server', ['verb'],
+    registry=REGISTRY)
+CONFIG_MAP_BYTES = prometheus_client.Gauge(
+    'config_operator_config_map_bytes', 'Size of the keys and values of a config map when it was last read or written',
+    ['namespace', 'config_map'], registry=REGISTRY)
+PATCH_BYTES = prometheus_client.Histogram(
+    'config_operator_config_map_patch_bytes', 'Size of the merge patches sent for config maps',
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576), registry=REGISTRY)
+PATCH_KEYS = prometheus_client.Histogram(
+    'config_operator_config_map_patch_keys', 'Number of keys changed by one config map patch',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500), registry=REGISTRY)
+PATCH_CONFLICTS = prometheus_client.Counter(
+    'config_operator_config_map_conflicts_total',
+    'Config map patches rejected because the config map changed in the meantime', registry=REGISTRY)
+PATCH_FAILURES = prometheus_client.Counter(
+    'config_operator_config_map_patch_failures_total',
+    'Config map writes that gave up after too many conflicts and are retried by kopf', registry=REGISTRY)
+SKIPPED_WRITES = prometheus_client.Counter(
+    'config_operator_skipped_writes_total', 'Key/value changes that were not written because the value is stored',
+    registry=REGISTRY)
+
+# spans are only recorded if opentelemetry is installed, exporters are configured through the OpenTelemetry SDK
+tracer = trace.get_tracer(__name__) if trace is not None else None
+
+
+def start_span(name: str, **kwargs):
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(name, **kwargs)
+
+
+def current_span_context():
+    return trace.get_current_span().get_span_context() if trace is not None else None
+
+
+def annotate_span(**attributes):
+    if trace is not None:
+        trace.get_current_span().set_attributes(attributes)
+
+
+def instrumented(handler):
+    """Records the duration and errors of a handler and runs it in its own span."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(**kwargs):
+        started = time.perf_counter()
+        try:
+            with start_span(name):
+                return await handler(**kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+async def load_kubernetes_config() -> kubernetes_asyncio.client.Configuration:
+    configuration = kubernetes_asyncio.client.Configuration()
     if 'KUBERNETES_SERVICE_HOST' in os.environ:
         # We're running inside a Kubernetes cluster
-        return kubernetes.config.load_incluster_config()
+        kubernetes_asyncio.config.load_incluster_config(client_configuration=configuration,
+                                                        try_refresh_token=API_TOKEN_REFRESH)
     else:
         # We're running outside the cluster
-        return kubernetes.config.load_kube_config()
+        await kubernetes_asyncio.config.load_kube_config(client_configuration=configuration)
+    configuration.connection_pool_maxsize = API_POOL_SIZE
+    return configuration
 
 
-@kopf.on.create('configserver')
-def create_fn(meta, spec, **kwargs):
-    client = ApiClient(configuration=load_kubernetes_config())
-    api = CoreV1Api(api_client=client)
-    apps_api = AppsV1Api(api_client=client)
-    crd_api = CustomObjectsApi(api_client=client)
+class InstrumentedApiClient(ApiClient):
+    """API client that records the number and latency of requests per verb."""
+    verbs = {"GET": "get", "POST": "create", "PUT": "update", "PATCH": "patch", "DELETE": "delete"}
+
+    def request(self, method, url, *args, **kwargs):
+        return self._observe(self.verbs.get(method, method.lower()), super().request(method, url, *args, **kwargs))
+
+    async def _observe(self, verb: str, request):
+        started = time.perf_counter()
+        code = "error"
+        try:
+            response = await request
+            code = str(response.status)
+            return response
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            code = str(e.status)
+            raise
+        finally:
+            API_DURATION.labels(verb).observe(time.perf_counter() - started)
+            API_REQUESTS.labels(verb, code).inc()
+
+
+_api_client: ApiClient | None = None
+
+
+def get_api_client() -> ApiClient:
+    """The API client shared by all handlers, so connections to the API server are reused between events."""
+    if _api_client is None:
+        raise kopf.TemporaryError("Kubernetes API client is not initialized yet", delay=1)
+    return _api_client
+
+
+_metrics_server = None
+
+
+@kopf.on.startup()
+async def configure_fn(settings: kopf.OperatorSettings, logger, **kwargs):
+    global _api_client, _metrics_server
+    settings.batching.worker_limit = MAX_WORKERS
+    _api_client = InstrumentedApiClient(configuration=await load_kubernetes_config())
+    if METRICS_PORT and _metrics_server is None:
+        try:
+            _metrics_server, _ = prometheus_client.start_http_server(METRICS_PORT, registry=REGISTRY)
+        except OSError as e:
+            # retrying would not free the port, the operator works without its metrics
+            logger.error(f"Failed to serve metrics on port {METRICS_PORT}: {e}")
+
+
+@kopf.on.cleanup()
+async def cleanup_fn(**kwargs):
+    global _api_client, _metrics_server
+    if _api_client is not None:
+        await _api_client.close()
+        _api_client = None
+    if _metrics_server is not None:
+        # free the port for the next operator run in this process
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+
+def shard_config_map(name: str, shard: int) -> str:
+    """Name of the config map that holds one shard of the values of a config server."""
+    return f"{name}-values" if shard == 0 else f"{name}-values-{shard}"
+
+
+def shard_config_maps(name: str, spec) -> list[str]:
+    return [shard_config_map(name, shard) for shard in range(spec.get("shards", 1))]
+
+
+def shard_of(key: str, shards: int) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big") % shards
 
-    name = meta["name"]
-    namespace = meta["namespace"]
 
-    # Read all existing Key/Value pairs and add them to the ConfigMap data
-    cfg_map_data = dict()
-    kv_pairs = crd_api.list_namespaced_custom_object("datalab.tuwien.ac.at", "v1", namespace, "keyvaluepairs")
-    kv_specs = map(lambda kvp: kvp["spec"], kv_pairs["items"])
-    for kv_spec in kv_specs:
-        if kv_spec["config"] == name:
-            cfg_map_data[kv_spec["key"]] = json.dumps(kv_spec["value"])
-
-    # Create the ConfigMap
-    configmap_manifest = V1ConfigMap(api_version="v1",
-                                     metadata={"name": f"{name}-values", "namespace": namespace},
-                                     data=cfg_map_data)
-    api.create_namespaced_config_map(namespace, body=configmap_manifest)
-
-    # Create the service for the deployment
-    service = V1Service(api_version="v1",
-                        metadata={"name": name, "namespace": namespace},
-                        spec={"type": "ClusterIP",
-                              "ports": [
-                                  {"protocol": "TCP", "port": spec["containerPort"],
-                                   "targetPort": spec["containerPort"], "name": "http"}
-                              ],
-                              "selector": {"app": name}})
-    api.create_namespaced_service(namespace, body=service)
-
-    # Create the deployment
-    server_deployment_manifest = {
+def shard_data(data: dict[str, str], shards: int) -> list[dict[str, str]]:
+    sharded = [{} for _ in range(shards)]
+    for key, value in data.items():
+        sharded[shard_of(key, shards)][key] = value
+    return sharded
+
+
+def service_manifest(name: str, namespace: str, spec) -> dict:
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {"type": "ClusterIP",
+                 "ports": [
+                     {"protocol": "TCP", "port": spec["containerPort"],
+                      "targetPort": spec["containerPort"], "name": "http"}
+                 ],
+                 "selector": {"app": name}}
+    }
+
+
+def deployment_manifest(name: str, namespace: str, spec) -> dict:
+    manifest = {
         "kind": "Deployment",
         "apiVersion": "apps/v1",
         "metadata": {
@@ -63,7 +233,6 @@ def create_fn(meta, spec, **kwargs):
             }
         },
         "spec": {
-            "replicas": 1,
             "selector": {
                 "matchLabels": {
                     "app": name
@@ -88,86 +257,579 @@ def create_fn(meta, spec, **kwargs):
                         "env": [
                             {"name": "CONFIG_SERVER_DIR", "value": spec["configMountPath"]},
                             {"name": "CONFIG_SERVER_PORT", "value": str(spec["containerPort"])},
+                            *source_env(name, spec),
                         ],
+                        "resources": spec.get("resources", {}),
                         "volumeMounts": [{
                             "name": "config",
                             "mountPath": spec["configMountPath"],
                         }]
                     }],
-                    "volumes": [{
-                        "name": "config",
-                        "configMap": {
-                            "defaultMode": 444,
-                            "name": f"{name}-values",
-                        }
-                    }]
+                    "volumes": [config_volume(name, spec)]
                 }
             }
         }
     }
-    apps_api.create_namespaced_deployment(namespace, body=server_deployment_manifest)
+    # null removes the service account with a merge patch when the servers stop watching their config map
+    manifest["spec"]["template"]["spec"]["serviceAccountName"] = name if watches_config_map(spec) else None
+    autoscaling = spec.get("autoscaling", {})
+    if not autoscaling.get("enabled", False):
+        # the number of replicas is left to the autoscaler otherwise
+        manifest["spec"]["replicas"] = spec.get("replicas", 1)
+    return manifest
+
+
+def config_volume(name: str, spec) -> dict:
+    if spec.get("shards", 1) == 1:
+        return {"name": "config", "configMap": {"defaultMode": 444, "name": f"{name}-values"}}
+    # kubelet merges the keys of all shards into one directory and swaps them in together
+    sources = [{"configMap": {"name": config_map}} for config_map in shard_config_maps(name, spec)]
+    return {"name": "config", "projected": {"defaultMode": 444, "sources": sources}}
+
+
+def watches_config_map(spec) -> bool:
+    """Whether the servers watch their config map through the API instead of waiting for kubelet to sync the mount."""
+    return spec.get("source", "volume") == "kubernetes"
+
+
+def source_env(name: str, spec) -> list[dict]:
+    if not watches_config_map(spec):
+        return []
+    return [
+        {"name": "CONFIG_SERVER_SOURCE", "value": "kubernetes"},
+        {"name": "CONFIG_SERVER_CONFIG_MAP", "value": ",".join(shard_config_maps(name, spec))},
+        {"name": "CONFIG_SERVER_NAMESPACE", "valueFrom": {"fieldRef": {"fieldPath": "metadata.namespace"}}},
+    ]
+
+
+def service_account_manifests(name: str, namespace: str, spec) -> tuple[dict | None, dict | None, dict | None]:
+    """Service account of the servers that may only read their own config map, if they watch it."""
+    if not watches_config_map(spec):
+        return None, None, None
+    metadata = {"name": name, "namespace": namespace}
+    service_account = {"apiVersion": "v1", "kind": "ServiceAccount", "metadata": metadata}
+    role = {
+        "apiVersion": "rbac.authorization.k8s.io/v1",
+        "kind": "Role",
+        "metadata": metadata,
+        # list and watch are restricted to the config map by the metadata.name field selector of the server
+        "rules": [{"apiGroups": [""], "resources": ["configmaps"], "resourceNames": shard_config_maps(name, spec),
+                   "verbs": ["get", "list", "watch"]}]
+    }
+    role_binding = {
+        "apiVersion": "rbac.authorization.k8s.io/v1",
+        "kind": "RoleBinding",
+        "metadata": metadata,
+        "roleRef": {"apiGroup": "rbac.authorization.k8s.io", "kind": "Role", "name": name},
+        "subjects": [{"kind": "ServiceAccount", "name": name, "namespace": namespace}]
+    }
+    return service_account, role, role_binding
+
+
+def autoscaler_manifest(name: str, namespace: str, spec) -> dict | None:
+    autoscaling = spec.get("autoscaling", {})
+    if not autoscaling.get("enabled", False):
+        return None
+    return {
+        "apiVersion": "autoscaling/v2",
+        "kind": "HorizontalPodAutoscaler",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {
+            "scaleTargetRef": {"apiVersion": "apps/v1", "kind": "Deployment", "name": name},
+            "minReplicas": autoscaling.get("minReplicas", 1),
+            "maxReplicas": autoscaling.get("maxReplicas", 10),
+            "metrics": [{
+                "type": "Resource",
+                "resource": {
+                    "name": "cpu",
+                    "target": {"type": "Utilization",
+                               "averageUtilization": autoscaling.get("targetCPUUtilizationPercentage", 80)}
+                }
+            }]
+        }
+    }
+
+
+def disruption_budget_manifest(name: str, namespace: str, spec) -> dict | None:
+    autoscaling = spec.get("autoscaling", {})
+    if autoscaling.get("enabled", False):
+        max_replicas = autoscaling.get("maxReplicas", 10)
+    else:
+        max_replicas = spec.get("replicas", 1)
+    if max_replicas < 2:
+        return None  # a single replica cannot be kept available during voluntary disruptions anyway
+    return {
+        "apiVersion": "policy/v1",
+        "kind": "PodDisruptionBudget",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {
+            "maxUnavailable": 1,
+            "selector": {"matchLabels": {"app": name}}
+        }
+    }
+
+
+async def _apply(create, patch, delete, name: str, namespace: str, manifest: dict | None):
+    """Create or update an object from its manifest, ``None`` removes the object if it exists."""
+    try:
+        if manifest is None:
+            await delete(name, namespace)
+        else:
+            # a merge patch replaces lists like the containers as a whole, so the object matches the manifest
+            await patch(name, namespace, body=manifest, _content_type="application/merge-patch+json")
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+        if manifest is not None:
+            await create(namespace, body=manifest)
+
+
+async def _apply_server(name: str, namespace: str, spec):
+    client = get_api_client()
+    api = CoreV1Api(api_client=client)
+    apps_api = AppsV1Api(api_client=client)
+    autoscaling_api = AutoscalingV2Api(api_client=client)
+    policy_api = PolicyV1Api(api_client=client)
+    rbac_api = RbacAuthorizationV1Api(api_client=client)
+
+    service_account, role, role_binding = service_account_manifests(name, namespace, spec)
+    await _apply(api.create_namespaced_service_account, api.patch_namespaced_service_account,
+                 api.delete_namespaced_service_account, name, namespace, service_account)
+    await _apply(rbac_api.create_namespaced_role, rbac_api.patch_namespaced_role, rbac_api.delete_namespaced_role,
+                 name, namespace, role)
+    await _apply(rbac_api.create_namespaced_role_binding, rbac_api.patch_namespaced_role_binding,
+                 rbac_api.delete_namespaced_role_binding, name, namespace, role_binding)
+    await _apply(api.create_namespaced_service, api.patch_namespaced_service, api.delete_namespaced_service,
+                 name, namespace, service_manifest(name, namespace, spec))
+    await _apply(apps_api.create_namespaced_deployment, apps_api.patch_namespaced_deployment,
+                 apps_api.delete_namespaced_deployment, name, namespace, deployment_manifest(name, namespace, spec))
+    await _apply(autoscaling_api.create_namespaced_horizontal_pod_autoscaler,
+                 autoscaling_api.patch_namespaced_horizontal_pod_autoscaler,
+                 autoscaling_api.delete_namespaced_horizontal_pod_autoscaler,
+                 name, namespace, autoscaler_manifest(name, namespace, spec))
+    await _apply(policy_api.create_namespaced_pod_disruption_budget,
+                 policy_api.patch_namespaced_pod_disruption_budget,
+                 policy_api.delete_namespaced_pod_disruption_budget,
+                 name, namespace, disruption_budget_manifest(name, namespace, spec))
+
+
+@kopf.index('keyvaluepair')
+async def key_value_index(namespace, meta, spec, **kwargs):
+    """Keeps the encoded values of all key/value pairs grouped by the config server they belong to."""
+    if meta.get("deletionTimestamp"):
+        return None  # its key is about to be removed from the config map
+    # config_map.data has to be of type dict[str, str] so encode values as json string
+    return {(namespace, spec["config"]): (spec["key"], json.dumps(spec["value"]))}
+
+
+@kopf.index('configserver')
+async def config_server_index(namespace, name, spec, **kwargs):
+    """Settings of each config server that are needed to write one of its keys."""
+    return {(namespace, name): {"shards": spec.get("shards", 1),
+                                "compiledSnapshot": spec.get("compiledSnapshot", False)}}
+
+
+async def _write_shards(name: str, namespace: str, spec, data: dict[str, str], logger: logging.Logger):
+    """Create the config maps of all shards or bring existing ones to the given content."""
+    api = CoreV1Api(api_client=get_api_client())
+    compiled = spec.get("compiledSnapshot", False)
+    for config_map_name, values in zip(shard_config_maps(name, spec), shard_data(data, spec.get("shards", 1))):
+        binary_data = {snapshot_key(config_map_name): encode_snapshot(values)} if compiled else None
+        configmap_manifest = V1ConfigMap(api_version="v1",
+                                         metadata={"name": config_map_name, "namespace": namespace},
+                                         data=values, binary_data=binary_data)
+        try:
+            await api.create_namespaced_config_map(namespace, body=configmap_manifest)
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            if e.status != 409:
+                raise
+            await _patch_config_map_data(config_map_name, namespace, values, logger, prune=True, compiled=compiled)
+
+
+@kopf.on.create('configserver')
+@instrumented
+async def create_fn(meta, spec, logger, key_value_index: kopf.Index, **kwargs):
+    name = meta["name"]
+    namespace = meta["namespace"]
+
+    # Create the ConfigMaps with all existing Key/Value pairs of this config server
+    await _write_shards(name, namespace, spec, dict(key_value_index.get((namespace, name), [])), logger)
+
+    # Create the service, the deployment and the objects that scale it
+    await _apply_server(name, namespace, spec)
+
+
+@kopf.on.update('configserver', field='spec')
+@instrumented
+async def update_fn(meta, spec, old, logger, key_value_index: kopf.Index, **kwargs):
+    name = meta["name"]
+    namespace = meta["namespace"]
+    # with field='spec', kopf passes the old spec as old
+    old_spec = old or {}
+    old_config_maps = shard_config_maps(name, old_spec)
+
+    if (old_config_maps != shard_config_maps(name, spec)
+            or old_spec.get("compiledSnapshot", False) != spec.get("compiledSnapshot", False)):
+        # move the keys to their new shards (and add or remove the snapshots) before the servers mount them
+        await _write_shards(name, namespace, spec, dict(key_value_index.get((namespace, name), [])), logger)
+
+    # roll out the changed spec to the existing objects
+    await _apply_server(name, namespace, spec)
+
+    api = CoreV1Api(api_client=get_api_client())
+    for config_map_name in set(old_config_maps) - set(shard_config_maps(name, spec)):
+        try:
+            await api.delete_namespaced_config_map(config_map_name, namespace)
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+        content_hashes.forget((namespace, config_map_name))
 
 
 @kopf.on.delete('configserver')
-def delete_fn(meta, spec, **kwargs):
-    client = ApiClient(configuration=load_kubernetes_config())
+@instrumented
+async def delete_fn(meta, spec, **kwargs):
+    client = get_api_client()
     api = CoreV1Api(api_client=client)
     apps_api = AppsV1Api(api_client=client)
+    autoscaling_api = AutoscalingV2Api(api_client=client)
+    policy_api = PolicyV1Api(api_client=client)
+    rbac_api = RbacAuthorizationV1Api(api_client=client)
 
     name = meta["name"]
     namespace = meta["namespace"]
 
-    delete_calls = [lambda: apps_api.delete_namespaced_deployment(name, namespace),
+    delete_calls = [lambda: policy_api.delete_namespaced_pod_disruption_budget(name, namespace),
+                    lambda: autoscaling_api.delete_namespaced_horizontal_pod_autoscaler(name, namespace),
+                    lambda: apps_api.delete_namespaced_deployment(name, namespace),
                     lambda: api.delete_namespaced_service(name, namespace),
-                    lambda: api.delete_namespaced_config_map(f"{name}-values", namespace)]
+                    lambda: rbac_api.delete_namespaced_role_binding(name, namespace),
+                    lambda: rbac_api.delete_namespaced_role(name, namespace),
+                    lambda: api.delete_namespaced_service_account(name, namespace)]
+    delete_calls += [lambda config_map_name=config_map_name: api.delete_namespaced_config_map(config_map_name,
+                                                                                              namespace)
+                     for config_map_name in shard_config_maps(name, spec)]
 
     for func in delete_calls:
         try:
-            func()
-        except kubernetes.client.exceptions.ApiException as e:
+            await func()
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
             if e.status == 404:
                 continue  # ignore resources that have already been deleted
             else:
                 raise kopf.PermanentError(f"Failed to delete config server {name}: {e.reason}")
+    for config_map_name in shard_config_maps(name, spec):
+        content_hashes.forget((namespace, config_map_name))
+
+
+@kopf.timer('configserver', interval=RECONCILE_INTERVAL, initial_delay=RECONCILE_INTERVAL, idle=RECONCILE_INTERVAL)
+@instrumented
+async def reconcile_fn(meta, spec, key_value_index: kopf.Index, logger, **kwargs):
+    """Repair config maps that drifted from their key/value pairs, e.g. because a write was lost or edited by hand.
+
+    Costs a single read per config map shard, only the keys that differ are written.
+    """
+    name = meta["name"]
+    namespace = meta["namespace"]
+    data = dict(key_value_index.get((namespace, name), []))
+    for config_map_name, values in zip(shard_config_maps(name, spec), shard_data(data, spec.get("shards", 1))):
+        await _patch_config_map_data(config_map_name, namespace, values, logger, prune=True,
+                                     compiled=spec.get("compiledSnapshot", False))
+
+
+def content_hash(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class ContentHashes:
+    """Hashes of the values last seen in each config map, used to skip writes that would not change anything.
+
+    Only config maps that were read completely at least once are known, for all others every change is written.
+    """
+
+    def __init__(self):
+        self._hashes: dict[tuple[str, str], dict[str, str]] = {}
+
+    def unchanged(self, target: tuple[str, str], key: str, value: str | None) -> bool:
+        hashes = self._hashes.get(target)
+        if hashes is None:
+            return False
+        return hashes.get(key) == (None if value is None else content_hash(value))
+
+    def update(self, target: tuple[str, str], data: dict[str, str]):
+        self._hashes[target] = {key: content_hash(value) for key, value in data.items()}
+
+    def apply(self, target: tuple[str, str], data: dict[str, str | None]):
+        hashes = self._hashes.setdefault(target, {})
+        for key, value in data.items():
+            if value is None:
+                hashes.pop(key, None)
+            else:
+                hashes[key] = content_hash(value)
+
+    def forget(self, target: tuple[str, str]):
+        self._hashes.pop(target, None)
+
+
+content_hashes = ContentHashes()
+
+
+# Compiled snapshots use the snapshot file format of the config server (see srv/server.py): a header, one index
+# record per key (each directly followed by the UTF-8 encoded key) and the concatenated response bodies.
+SNAPSHOT_MAGIC = b"CSNP"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBQI16s")  # magic, format, generation, number of keys, version digest
+SNAPSHOT_INDEX = struct.Struct("<BQIH16s")  # flags, body offset, body length, key length, etag digest
+FLAG_INVALID = 1  # the body holds the error message of a value that is not valid JSON
+FLAG_COMPRESSED = 2  # the body is zlib compressed
+SNAPSHOT_KEY_PREFIX = ".config-snapshot"
+# smaller values are stored uncompressed, compressing them rarely saves anything
+COMPRESS_MIN_SIZE = 256
+
 
+def snapshot_key(config_map_name: str) -> str:
+    """Key of the compiled snapshot in the binaryData of a config map, unique across the shards of a server."""
+    return f"{SNAPSHOT_KEY_PREFIX}-{config_map_name}"
 
-def _get_config_map(config_name: str, namespace: str, logger: logging.Logger) -> tuple[V1ConfigMap | None, CoreV1Api]:
-    client = kubernetes.client.api_client.ApiClient(configuration=load_kubernetes_config())
-    api = kubernetes.client.CoreV1Api(api_client=client)
+
+def compile_snapshot(data: dict[str, str]) -> bytes:
+    """Serialize the values of a config map into a snapshot the config server can memory-map without parsing them.
+
+    Bodies are encoded like the server encodes responses, so ETags and versions match those of the plain values.
+    """
+    records, bodies, etags = [], [], []
+    keys = sorted(data)
+    offset = SNAPSHOT_HEADER.size + sum(SNAPSHOT_INDEX.size + len(key.encode()) for key in keys)
+    for key in keys:
+        try:
+            # same encoding as tornado.escape.json_encode
+            body = json.dumps(json.loads(data[key])).replace("</", "<\\/").encode()
+        except json.decoder.JSONDecodeError:
+            flags, stored, digest = FLAG_INVALID, b"not valid JSON", bytes(16)
+            etags.append(f"{key}\0not valid JSON\0")
+        else:
+            digest = hashlib.sha256(body).digest()[:16]
+            etags.append(f'{key}\0"{digest.hex()}"\0')
+            flags, stored = 0, body
+            if len(body) >= COMPRESS_MIN_SIZE:
+                compressed = zlib.compress(body)
+                if len(compressed) < len(body):
+                    flags, stored = FLAG_COMPRESSED, compressed
+        key_bytes = key.encode()
+        records.append(SNAPSHOT_INDEX.pack(flags, offset, len(stored), len(key_bytes), digest) + key_bytes)
+        bodies.append(stored)
+        offset += len(stored)
+    version = hashlib.sha256("".join(etags).encode()).digest()[:16]
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0, len(keys), version)
+    return b"".join([header, *records, *bodies])
+
+
+def encode_snapshot(data: dict[str, str]) -> str:
+    # binaryData values are base64 encoded in the API
+    return base64.b64encode(compile_snapshot(data)).decode()
+
+
+def data_size(data: dict[str, str]) -> int:
+    return sum(len(key.encode()) + len(value.encode()) for key, value in data.items())
+
+
+async def _get_config_map(config_map_name: str, namespace: str,
+                          logger: logging.Logger) -> tuple[V1ConfigMap | None, CoreV1Api]:
+    api = CoreV1Api(api_client=get_api_client())
     try:
-        config_map = api.read_namespaced_config_map(name=f"{config_name}-values", namespace=namespace)
+        config_map = await api.read_namespaced_config_map(name=config_map_name, namespace=namespace)
         if config_map.data is None:
             config_map.data = {}
+        content_hashes.update((namespace, config_map_name), config_map.data)
+        CONFIG_MAP_BYTES.labels(namespace, config_map_name).set(data_size(config_map.data))
         return config_map, api
-    except kubernetes.client.exceptions.ApiException as e:
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
         if e.status == 404:
-            logger.warning(
-                f"Config '{config_name}' not found! Key/Value pair will be added once a valid ConfigServer is created.")
+            content_hashes.forget((namespace, config_map_name))
+            logger.warning(f"Config map '{config_map_name}' not found! "
+                           f"Key/Value pair will be added once a valid ConfigServer is created.")
             return None, api
         else:
-            raise kopf.PermanentError(f"Failed to load config values '{config_name}': {e.reason}")
+            raise kopf.PermanentError(f"Failed to load config values '{config_map_name}': {e.reason}")
 
 
-@kopf.on.create('keyvaluepair')
-@kopf.on.update('keyvaluepair')
-def create_config_fn(meta, spec, logger, **kwargs):
-    # TODO: split update and create handlers to check if key already exists in create step
-    config_name = spec["config"]
-    namespace = meta["namespace"]
-    config_map, api = _get_config_map(config_name, namespace, logger)
+async def _patch_config_map_data(config_map_name: str, namespace: str, data: dict[str, str | None],
+                                 logger: logging.Logger, prune: bool = False, compiled: bool = False):
+    """Apply a JSON merge patch that only touches the given keys of the config map (``None`` removes a key).
+
+    Keys that already hold the given value are left out and nothing is written if no key changed. With ``prune``,
+    ``data`` is the complete content and all other keys are removed. With ``compiled``, the patch also replaces the
+    compiled snapshot of the resulting content, otherwise snapshots are removed so they cannot become stale.
+
+    The patch carries the resourceVersion of the config map it was computed against, so the API server rejects it
+    with 409 if the config map changed in the meantime. Conflicts are retried with a fresh read a bounded number of
+    times before kopf retries the whole handler.
+    """
+    for attempt in range(PATCH_RETRIES):
+        config_map, api = await _get_config_map(config_map_name, namespace, logger)
+        if config_map is None:
+            return
+
+        changes = {key: value for key, value in data.items() if config_map.data.get(key) != value}
+        if prune:
+            changes.update({key: None for key in config_map.data if key not in data})
+        content = {key: value for key, value in {**config_map.data, **changes}.items() if value is not None}
+        binary_data = config_map.binary_data or {}
+        if compiled:
+            binary_changes = {snapshot_key(config_map_name): encode_snapshot(content)} \
+                if changes or snapshot_key(config_map_name) not in binary_data else {}
+        else:
+            binary_changes = {key: None for key in binary_data if key.startswith(SNAPSHOT_KEY_PREFIX)}
+        if not changes and not binary_changes:
+            logger.debug(f"Config map '{config_map_name}' is up to date")
+            return
+
+        body = {"metadata": {"resourceVersion": config_map.metadata.resource_version}, "data": changes}
+        if binary_changes:
+            body["binaryData"] = binary_changes
+        PATCH_BYTES.observe(len(json.dumps(body)))
+        PATCH_KEYS.observe(len(changes))
+        try:
+            await api.patch_namespaced_config_map(name=config_map_name, namespace=namespace, body=body,
+                                                  _content_type="application/merge-patch+json")
+            content_hashes.apply((namespace, config_map_name), changes)
+            CONFIG_MAP_BYTES.labels(namespace, config_map_name).set(data_size(content))
+            return
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            if e.status != 409:
+                raise
+            PATCH_CONFLICTS.inc()
+            logger.info(f"Config map '{config_map_name}' was modified concurrently, "
+                        f"retrying ({attempt + 1}/{PATCH_RETRIES})")
+            await asyncio.sleep(PATCH_RETRY_BACKOFF * 2 ** attempt)
+
+    PATCH_FAILURES.inc()
+    raise kopf.TemporaryError(f"Failed to update config values '{config_map_name}': too many conflicts", delay=1)
+
 
+class _Batch:
+    def __init__(self):
+        self.data: dict[str, str | None] = {}
+        self.full = asyncio.Event()
+        self.done = asyncio.Event()
+        self.error: Exception | None = None
+        self.compiled = False
+        # spans of the handlers whose changes are part of the batch
+        self.span_contexts = []
+
+
+class ConfigMapWriteBatcher:
+    """Coalesces key/value changes of the same config map into a single patch.
+
+    The first handler that submits a change for a config map becomes the leader of a new batch: it waits up to
+    ``window`` seconds (or until ``size`` keys were collected) for other handlers to add their changes and then writes
+    all of them with one patch. The other handlers wait until the batch is written, so every handler only succeeds
+    once its change is stored and failures are retried by kopf as before.
+    """
+
+    def __init__(self, window: float = BATCH_WINDOW, size: int = BATCH_SIZE):
+        self.window = window
+        self.size = size
+        self._batches: dict[tuple[str, str], _Batch] = {}
+        # batches that wait for their flush or are being written
+        self._flushing: dict[tuple[str, str], list[_Batch]] = {}
+        self._flush_locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+    async def submit(self, config_map_name: str, namespace: str, key: str, value: str | None,
+                     logger: logging.Logger, compiled: bool = False):
+        target = (namespace, config_map_name)
+        # the hashes only reflect written changes, a pending change of the key may still overwrite the value
+        if content_hashes.unchanged(target, key, value) and not self._pending(target, key):
+            logger.debug(f"Key '{key}' of config map '{config_map_name}' is unchanged, skipping write")
+            SKIPPED_WRITES.inc()
+            return
+        batch = self._batches.get(target)
+        leader = batch is None
+        if leader:
+            batch = self._batches[target] = _Batch()
+            flush_lock = self._flush_locks.setdefault(target, asyncio.Lock())
+        batch.data[key] = value
+        batch.compiled = batch.compiled or compiled
+        if trace is not None:
+            batch.span_contexts.append(current_span_context())
+        if len(batch.data) >= self.size:
+            batch.full.set()
+
+        if not leader:
+            await batch.done.wait()
+            if batch.error is not None:
+                raise kopf.TemporaryError(f"Failed to update config values '{config_map_name}': {batch.error}", delay=1)
+            return
+
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # the followers fail and are retried by kopf, later changes start a new batch
+            batch.error = RuntimeError("the write was cancelled")
+            batch.done.set()
+            raise
+        finally:
+            del self._batches[target]
+        flushing = self._flushing.setdefault(target, [])
+        flushing.append(batch)
+        try:
+            # batches of the same config map are written in order
+            async with flush_lock:
+                logger.debug(f"Writing {len(batch.data)} key(s) to config map '{config_map_name}'")
+                # the write is linked to the spans of all key/value pair changes it carries
+                links = [trace.Link(context) for context in batch.span_contexts] if trace is not None else None
+                with start_span("write config map", links=links,
+                                attributes={"config_map": config_map_name, "namespace": namespace,
+                                            "keys": len(batch.data)}):
+                    await _patch_config_map_data(config_map_name, namespace, batch.data, logger,
+                                                 compiled=batch.compiled)
+        except Exception as e:
+            batch.error = e
+            raise
+        except asyncio.CancelledError:
+            batch.error = RuntimeError("the write was cancelled")
+            raise
+        finally:
+            flushing.remove(batch)
+            if not flushing:
+                self._flushing.pop(target, None)
+            batch.done.set()
+
+    def _pending(self, target: tuple[str, str], key: str) -> bool:
+        """Whether a change of the key is collected or being written but not yet stored in the content hashes."""
+        batch = self._batches.get(target)
+        return (batch is not None and key in batch.data) or any(
+            key in batch.data for batch in self._flushing.get(target, ()))
+
+
+config_map_writes = ConfigMapWriteBatcher()
+
+
+def _key_config_map(namespace: str, spec, config_server_index: kopf.Index) -> tuple[str, bool]:
+    """The config map that holds the key of a key/value pair and whether it carries a compiled snapshot."""
+    # unknown config servers have a single shard, writing to it fails until the config server is created
+    settings = next(iter(config_server_index.get((namespace, spec["config"]), [])),
+                    {"shards": 1, "compiledSnapshot": False})
+    return shard_config_map(spec["config"], shard_of(spec["key"], settings["shards"])), settings["compiledSnapshot"]
+
+
+@kopf.on.create('keyvaluepair')
+@kopf.on.update('keyvaluepair', field='spec')
+@instrumented
+async def create_config_fn(meta, spec, logger, config_server_index: kopf.Index, **kwargs):
+    config_map_name, compiled = _key_config_map(meta["namespace"], spec, config_server_index)
+    annotate_span(key=spec["key"], config_map=config_map_name, namespace=meta["namespace"])
     # config_map.data has to be of type dict[str, str] so encode values as json string
-    if config_map is not None:
-        config_map.data[spec["key"]] = json.dumps(spec["value"])
-        api.patch_namespaced_config_map(name=f"{config_name}-values", namespace=namespace, body=config_map)
+    await config_map_writes.submit(config_map_name, meta["namespace"], spec["key"], json.dumps(spec["value"]), logger,
+                                   compiled=compiled)
 
 
 @kopf.on.delete('keyvaluepair')
-def delete_config_fn(meta, spec, logger, **kwargs):
-    config_name = spec["config"]
-    namespace = meta["namespace"]
-    config_map, api = _get_config_map(config_name, namespace, logger)
-
-    if config_map is not None:
-        config_map.data.pop(spec["key"], None)
-        api.patch_namespaced_config_map(name=f"{config_name}-values", namespace=namespace, body=config_map)
+@instrumented
+async def delete_config_fn(meta, spec, logger, config_server_index: kopf.Index, **kwargs):
+    config_map_name, compiled = _key_config_map(meta["namespace"], spec, config_server_index)
+    annotate_span(key=spec["key"], config_map=config_map_name, namespace=meta["namespace"])
+    # a null value removes the key with a merge patch
+    await config_map_writes.submit(config_map_name, meta["namespace"], spec["key"], None, logger, compiled=compiled)
@@ -1,13 +1,54 @@
 import argparse
 import asyncio
+import bisect
+import concurrent.futures
+import fcntl
+import functools
+import gzip
+import hashlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import re
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 from pathlib import Path
+from types import MappingProxyType
+from typing import Callable, Iterable, Mapping
+
 import jmespath
+import prometheus_client
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 import tornado
+import tornado.escape
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.process
+import tornado.web
 
 log = logging.getLogger(__name__)
 
@@ -23,53 +64,1489 @@ def get_parser() -> argparse.ArgumentParser:
                         default=int(os.environ.get('CONFIG_SERVER_PORT', '80')),
                         type=int,
                         help='port to listen on')
+    parser.add_argument('--reload-interval',
+                        default=float(os.environ.get('CONFIG_SERVER_RELOAD_INTERVAL', '1.0')),
+                        type=float,
+                        help='minimum number of seconds between checks of the config directory for changes')
+    parser.add_argument('--query-cache-size',
+                        default=int(os.environ.get('CONFIG_SERVER_QUERY_CACHE_SIZE', '256')),
+                        type=int,
+                        help='number of query results that are cached per snapshot generation')
+    parser.add_argument('--path-cache-size',
+                        default=int(os.environ.get('CONFIG_SERVER_PATH_CACHE_SIZE', '1024')),
+                        type=int,
+                        help='number of encoded sub-documents (/config/<key>/<path>) that are cached')
+    parser.add_argument('--variant-cache-size',
+                        default=int(os.environ.get('CONFIG_SERVER_VARIANT_CACHE_SIZE', '1024')),
+                        type=int,
+                        help='number of query, batch and sub-document responses cached in other media types and '
+                             'content codings (whole values are cached with the snapshot)')
+    parser.add_argument('--query-workers',
+                        default=int(os.environ.get('CONFIG_SERVER_QUERY_WORKERS', '4')),
+                        type=int,
+                        help='number of threads that evaluate queries (the config directory is reloaded on a '
+                             'thread of its own)')
+    parser.add_argument('--query-timeout',
+                        default=float(os.environ.get('CONFIG_SERVER_QUERY_TIMEOUT', '5.0')),
+                        type=float,
+                        help='maximum number of seconds a single query may run before it is rejected')
+    parser.add_argument('--query-max-bytes',
+                        default=int(os.environ.get('CONFIG_SERVER_QUERY_MAX_BYTES', str(16 * 1024 * 1024))),
+                        type=int,
+                        help='maximum size of an encoded query result before the query is rejected')
+    parser.add_argument('--index-fields',
+                        default=os.environ.get('CONFIG_SERVER_INDEX_FIELDS', ''),
+                        type=str,
+                        help='comma-separated fields of the values (dotted paths like owner.team) to index, queries '
+                             'like "team == \'x\'" then only evaluate the keys that match and lookups with "where" '
+                             'are answered from the index')
+    parser.add_argument('-w', '--workers',
+                        default=int(os.environ.get('CONFIG_SERVER_WORKERS', '1')),
+                        type=int,
+                        help='number of server processes that share the port (SO_REUSEPORT) and one snapshot file')
+    parser.add_argument('--metrics-port',
+                        default=_optional_int(os.environ.get('CONFIG_SERVER_METRICS_PORT')),
+                        type=int,
+                        help='serve /metrics on this port instead of the API port. With --workers, every worker '
+                             'serves its own metrics on this port plus its worker number (default: --port + 1), '
+                             'scrape each of them as a separate target')
+    parser.add_argument('--snapshot-dir',
+                        default=os.environ.get('CONFIG_SERVER_SNAPSHOT_DIR', _default_snapshot_dir()),
+                        type=str,
+                        help='directory for the snapshot file that is shared between worker processes')
+    parser.add_argument('--source',
+                        default=os.environ.get('CONFIG_SERVER_SOURCE', 'directory'),
+                        choices=['directory', 'kubernetes'],
+                        help='read the values from the mounted config directory or watch the config map through the '
+                             'Kubernetes API, which sees changes without waiting for kubelet to update the mount')
+    parser.add_argument('--config-map',
+                        default=os.environ.get('CONFIG_SERVER_CONFIG_MAP'),
+                        type=str,
+                        help='name of the config map to watch with --source kubernetes, values that are sharded over '
+                             'several config maps are merged from a comma-separated list of names')
+    parser.add_argument('--namespace',
+                        default=os.environ.get('CONFIG_SERVER_NAMESPACE', _default_namespace()),
+                        type=str,
+                        help='namespace of the config map to watch with --source kubernetes')
+    parser.add_argument('--api-url',
+                        default=os.environ.get('CONFIG_SERVER_API_URL', _default_api_url()),
+                        type=str,
+                        help='URL of the Kubernetes API server, defaults to the in-cluster address')
     return parser
 
 
-class KeyValueHandler(tornado.web.RequestHandler):
-    def get(self, key: str):
+def _optional_int(value: str | None) -> int | None:
+    return int(value) if value else None
+
+
+def _default_snapshot_dir() -> str:
+    # prefer a memory-backed file system so the shared snapshot never touches the disk
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/config-server'
+    return os.path.join(tempfile.gettempdir(), 'config-server')
+
+
+def content_etag(body: bytes) -> str:
+    """Strong ETag derived from the content hash of an encoded response body."""
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+class ConfigEntry:
+    """Parsed value of a single key together with its pre-encoded JSON response body.
+
+    Bodies in other media types and content codings are added to ``variants`` the first time they are requested, so
+    each representation is encoded once per snapshot.
+    """
+    __slots__ = ('value', 'body', 'error', 'etag', 'variants')
+
+    def __init__(self, value=None, body: bytes = b'', error: str | None = None):
+        self.value = value
+        self.body = body
+        self.error = error
+        self.etag = content_etag(body) if error is None else None
+        self.variants: dict[tuple[str, str | None], tuple[bytes, str]] = {}
+
+    @classmethod
+    def from_text(cls, text: str) -> 'ConfigEntry':
         try:
-            path = self.settings['config_values'] / key
-            with open(path, 'r') as f:
-                value = json.load(f)
-            self.write(value)
+            value = json.loads(text)
         except json.decoder.JSONDecodeError:
-            raise tornado.web.HTTPError(400, reason=f"Failed to load values for key '{key}': not valid JSON")
-        except FileNotFoundError:
-            raise tornado.web.HTTPError(404, reason=f"Key '{key}' not found")
+            return cls(error="not valid JSON")
+        return cls(value=value, body=tornado.escape.json_encode(value).encode())
+
+
+_UNSET = object()
+
+
+class MappedConfigEntry(ConfigEntry):
+    """Entry of a memory-mapped snapshot file. The body is read from the map and only parsed on first access."""
+    __slots__ = ('_buffer', '_offset', '_length', '_value')
+
+    def __init__(self, buffer: bytes | mmap.mmap, offset: int, length: int, etag: str):
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+        self._value = _UNSET
+        self.error = None
+        self.etag = etag
+        self.variants = {}
+
+    @property
+    def body(self) -> bytes:
+        return self._buffer[self._offset:self._offset + self._length]
+
+    @property
+    def value(self):
+        if self._value is _UNSET:
+            self._value = json.loads(self.body)
+        return self._value
+
+
+class CompressedConfigEntry(MappedConfigEntry):
+    """Entry of a memory-mapped snapshot with a zlib compressed body, which is decompressed on first access."""
+    __slots__ = ('_body',)
+
+    def __init__(self, buffer: bytes | mmap.mmap, offset: int, length: int, etag: str):
+        super().__init__(buffer, offset, length, etag)
+        self._body = None
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = zlib.decompress(self._buffer[self._offset:self._offset + self._length])
+        return self._body
+
+
+class ConfigSnapshot:
+    """Immutable view of all key/value pairs of the config directory at one point in time."""
+
+    def __init__(self, entries: dict[str, ConfigEntry], generation: int = 0, version: str | None = None,
+                 size: int | None = None):
+        self.entries: Mapping[str, ConfigEntry] = MappingProxyType(entries)
+        self.generation = generation
+        self.created = time.time()
+        # number of bytes of the encoded values
+        self.size = size if size is not None else sum(len(entry.body) for entry in entries.values())
+
+        if version is None:
+            # the version only depends on the content, so it is comparable across restarts and replicas
+            hasher = hashlib.sha256()
+            for key in sorted(entries):
+                hasher.update(f"{key}\0{entries[key].etag or entries[key].error}\0".encode())
+            version = hasher.hexdigest()[:32]
+        self.version = version
+
+    def __len__(self):
+        return len(self.entries)
+
+    @functools.cached_property
+    def sorted_keys(self) -> list[str]:
+        """All keys in sorted order, the order paginated queries walk through the snapshot."""
+        return sorted(self.entries)
+
+
+# Snapshot files start with a header, followed by one index record per key (each directly followed by the UTF-8
+# encoded key) and the concatenated response bodies. Offsets in the index are relative to the start of the file.
+SNAPSHOT_MAGIC = b"CSNP"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBQI16s")  # magic, format, generation, number of keys, version digest
+SNAPSHOT_INDEX = struct.Struct("<BQIH16s")  # flags, body offset, body length, key length, etag digest
+FLAG_INVALID = 1  # the body holds the error message of a value that is not valid JSON
+FLAG_COMPRESSED = 2  # the body is zlib compressed (only written by the operator, see compiledSnapshot)
+# files of the config directory that hold snapshots compiled by the operator instead of a single value
+COMPILED_SNAPSHOT_PREFIX = '.config-snapshot'
+
+
+def serialize_snapshot(snapshot: ConfigSnapshot) -> bytes:
+    records, bodies = [], []
+    offset = SNAPSHOT_HEADER.size + sum(SNAPSHOT_INDEX.size + len(key.encode()) for key in snapshot.entries)
+    for key, entry in snapshot.entries.items():
+        if entry.error is not None:
+            flags, body, digest = FLAG_INVALID, entry.error.encode(), bytes(16)
+        else:
+            flags, body, digest = 0, entry.body, bytes.fromhex(entry.etag.strip('"'))
+        key_bytes = key.encode()
+        records.append(SNAPSHOT_INDEX.pack(flags, offset, len(body), len(key_bytes), digest) + key_bytes)
+        bodies.append(body)
+        offset += len(body)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, snapshot.generation, len(snapshot.entries),
+                                  bytes.fromhex(snapshot.version))
+    return b"".join([header, *records, *bodies])
+
+
+def map_snapshot(buffer: bytes | mmap.mmap) -> ConfigSnapshot:
+    """Build a snapshot on top of a serialized snapshot without parsing any of its values."""
+    magic, fmt, generation, count, version = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+    if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+        raise ValueError("Not a config snapshot file")
+    entries = {}
+    position = SNAPSHOT_HEADER.size
+    for _ in range(count):
+        flags, offset, length, key_length, digest = SNAPSHOT_INDEX.unpack_from(buffer, position)
+        position += SNAPSHOT_INDEX.size
+        key = buffer[position:position + key_length].decode()
+        position += key_length
+        if flags & FLAG_INVALID:
+            entries[key] = ConfigEntry(error=buffer[offset:offset + length].decode())
+        elif flags & FLAG_COMPRESSED:
+            entries[key] = CompressedConfigEntry(buffer, offset, length, f'"{digest.hex()}"')
+        else:
+            entries[key] = MappedConfigEntry(buffer, offset, length, f'"{digest.hex()}"')
+    return ConfigSnapshot(entries, generation, version.hex(), size=len(buffer))
+
+
+def map_snapshot_file(path: Path) -> ConfigSnapshot:
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return map_snapshot(buffer)
+
+
+def _data_dir(directory: Path) -> Path:
+    # kubelet mounts config maps as '<key> -> ..data/<key>' symlinks, where '..data' itself is a symlink to a
+    # timestamped directory that is swapped atomically on update. Reading through the resolved target avoids
+    # mixing files of two revisions.
+    data_link = directory / '..data'
+    if data_link.is_symlink():
+        return data_link.resolve()
+    return directory
+
+
+def directory_stamp(directory: Path):
+    """Cheap fingerprint of the config directory that changes whenever its contents change."""
+    data_link = directory / '..data'
+    if data_link.is_symlink():
+        return os.readlink(data_link)
+    stamp = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                stamp.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(stamp))
+
+
+def source_mtime(directory: Path) -> float:
+    """Time of the last change of the config directory as recorded by the file system."""
+    data_link = directory / '..data'
+    if data_link.is_symlink():
+        # time kubelet swapped in the current revision of the config map
+        return data_link.lstat().st_mtime
+    return max((f.stat().st_mtime for f in directory.iterdir() if f.is_file()), default=directory.stat().st_mtime)
+
+
+def load_snapshot(directory: Path, generation: int = 0) -> ConfigSnapshot:
+    """Load all values of the config directory.
+
+    Snapshots compiled by the operator are memory-mapped, so the values they contain are neither read nor parsed
+    until they are requested. Only the remaining files are parsed.
+    """
+    data_dir = _data_dir(directory)
+    entries = {}
+    # sizes are summed up here, computing them from the entries would decompress all compiled values
+    size = 0
+    json_files = []
+    for path in data_dir.iterdir():
+        if path.name.startswith('..') or not path.is_file():
+            continue
+        if not path.name.startswith(COMPILED_SNAPSHOT_PREFIX):
+            json_files.append(path)
+            continue
+        try:
+            compiled = map_snapshot_file(path)
+        except (OSError, ValueError, struct.error) as e:
+            log.warning(f"Failed to map compiled snapshot {path}: {e}")
+            continue
+        entries.update(compiled.entries)
+        size += compiled.size
+    compiled_keys = set(entries)
+    for json_file in json_files:
+        if json_file.name in compiled_keys:
+            continue
+        try:
+            entry = ConfigEntry.from_text(json_file.read_text())
+        except OSError as e:
+            log.warning(f"Failed to read file {json_file}: {e}")
+            continue
+        if entry.error is not None:
+            log.warning(f"Failed to load JSON from file {json_file}")
+        entries[json_file.name] = entry
+        size += len(entry.body)
+    return ConfigSnapshot(entries, generation, size=size)
+
+
+class SnapshotStore:
+    """Holds the current :class:`ConfigSnapshot` of a directory and rebuilds it when the directory changes.
 
-    def post(self, key: str = None):
-        body = json.loads(self.request.body)
+    The directory is checked at most once every ``reload_interval`` seconds by :meth:`current`, so most lookups do
+    not touch the disk. Checks and reloads run on ``executor`` to keep blocking I/O off the IOLoop.
+    """
 
-        query = jmespath.compile(body.get('query', '*'))
-        directory: Path = self.settings['config_values']
-        response = {}
+    def __init__(self, directory: Path, reload_interval: float = 0.0,
+                 executor: concurrent.futures.Executor | None = None):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._last_check = 0.0
+        self._pending: asyncio.Future | None = None
+        self.source_changed = 0.0
+        self._snapshot = ConfigSnapshot({})
+        self.listeners: list[Callable[[ConfigSnapshot, ConfigSnapshot], None]] = []
+        self.refresh()
 
-        for json_file in directory.iterdir():
-            if json_file.is_file():
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        """The most recently loaded snapshot, without checking the directory for changes."""
+        return self._snapshot
+
+    async def current(self) -> ConfigSnapshot:
+        """The current snapshot, reloading it first if the directory may have changed."""
+        if time.monotonic() - self._last_check >= self.reload_interval:
+            # concurrent requests share a single check of the directory
+            if self._pending is None or self._pending.done():
+                self._pending = asyncio.get_running_loop().run_in_executor(self.executor, self.refresh)
+            await asyncio.shield(self._pending)
+        return self._snapshot
+
+    def refresh(self) -> bool:
+        """Reload the snapshot if the directory changed. Returns True if a new snapshot was installed."""
+        with self._lock:
+            self._last_check = time.monotonic()
+            stamp = directory_stamp(self.directory)
+            if stamp == self._stamp:
+                return False
+            previous = self._snapshot
+            snapshot = self.load(stamp)
+            self._stamp = stamp
+            self._snapshot = snapshot
+            self.source_changed = source_mtime(self.directory)
+        self._notify(previous, snapshot)
+        return True
+
+    def _notify(self, previous: ConfigSnapshot, snapshot: ConfigSnapshot):
+        log.info(f"Loaded config snapshot generation {snapshot.generation} with {len(snapshot)} keys")
+        for listener in self.listeners:
+            listener(previous, snapshot)
+
+    async def ready(self):
+        """Wait until the first snapshot is loaded."""
+
+    def load(self, stamp) -> ConfigSnapshot:
+        return load_snapshot(self.directory, self._snapshot.generation + 1)
+
+
+class SharedSnapshotStore(SnapshotStore):
+    """Snapshot store for multiple worker processes that share one serialized snapshot file.
+
+    The first worker that notices a change parses the directory and writes the snapshot file while holding a file
+    lock; all workers then memory-map that file, so the config is parsed once and its pages are shared between the
+    processes. Generations are taken from the file, so all workers report the same generation for the same content.
+    """
+    keep_files = 3
+
+    def __init__(self, directory: Path, snapshot_dir: Path, reload_interval: float = 0.0,
+                 executor: concurrent.futures.Executor | None = None):
+        directory_hash = hashlib.sha256(str(directory.resolve()).encode()).hexdigest()[:12]
+        self.snapshot_dir = snapshot_dir / directory_hash
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        super().__init__(directory, reload_interval, executor)
+
+    def _snapshot_files(self) -> list[Path]:
+        return sorted(self.snapshot_dir.glob("snapshot-*.bin"))
+
+    def _map_existing(self, stamp_hash: str) -> ConfigSnapshot | None:
+        for path in self.snapshot_dir.glob(f"snapshot-*-{stamp_hash}.bin"):
+            try:
+                return map_snapshot_file(path)
+            except FileNotFoundError:
+                # removed by another worker in the meantime
+                continue
+        return None
+
+    def load(self, stamp) -> ConfigSnapshot:
+        stamp_hash = hashlib.sha256(repr(stamp).encode()).hexdigest()[:16]
+        snapshot = self._map_existing(stamp_hash)
+        if snapshot is not None:
+            return snapshot
+
+        with open(self.snapshot_dir / ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshot = self._map_existing(stamp_hash)
+            if snapshot is not None:
+                return snapshot
+
+            files = self._snapshot_files()
+            generation = max([int(f.name.split('-')[1]) for f in files] + [self._snapshot.generation]) + 1
+            path = self.snapshot_dir / f"snapshot-{generation:012d}-{stamp_hash}.bin"
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(serialize_snapshot(load_snapshot(self.directory, generation)))
+            os.replace(tmp_path, path)
+            # mapped files stay valid after unlinking, old files are only kept for workers that lag behind
+            for old in files[:max(len(files) + 1 - self.keep_files, 0)]:
+                old.unlink(missing_ok=True)
+            return map_snapshot_file(path)
+
+
+SERVICE_ACCOUNT_DIR = Path('/var/run/secrets/kubernetes.io/serviceaccount')
+
+
+def _default_api_url() -> str | None:
+    host, port = os.environ.get('KUBERNETES_SERVICE_HOST'), os.environ.get('KUBERNETES_SERVICE_PORT', '443')
+    if host is None:
+        return None
+    if ':' in host:
+        host = f'[{host}]'
+    return f'https://{host}:{port}'
+
+
+def _default_namespace() -> str:
+    try:
+        return (SERVICE_ACCOUNT_DIR / 'namespace').read_text().strip()
+    except OSError:
+        return 'default'
+
+
+class WatchExpired(Exception):
+    """The resourceVersion a watch should resume from is no longer available on the API server."""
+
+
+class KubernetesSnapshotStore(SnapshotStore):
+    """Snapshot store that follows config maps through the Kubernetes API instead of their volume mount.
+
+    kubelet only updates mounted config maps after its sync period, a list+watch of the config map receives changes
+    as soon as the API server stores them. The watch resumes from the last seen resourceVersion after disconnects and
+    lists the config map again if that version expired. Generations are taken from the resourceVersions, so they
+    are comparable between worker processes and replicas.
+
+    Values that are sharded over several config maps are watched separately and merged into one snapshot.
+    """
+    watch_timeout = 300
+    retry_delay = 1.0
+
+    def __init__(self, names: str | list[str], namespace: str, api_url: str, token_file: Path | None = None,
+                 ca_file: Path | None = None):
+        self.names = [names] if isinstance(names, str) else list(names)
+        self.namespace = namespace
+        self.api_url = api_url.rstrip('/')
+        self.token_file = token_file
+        self.ca_file = ca_file
+        self.resource_versions: dict[str, str] = {}
+        self._texts: dict[str, dict[str, str]] = {}
+        self._loaded = tornado.locks.Event()
+        self._tasks: list[asyncio.Task] = []
+        super().__init__(Path(f"configmaps/{namespace}/{','.join(self.names)}"))
+
+    def refresh(self) -> bool:
+        # changes are pushed by the watches
+        return False
+
+    async def current(self) -> ConfigSnapshot:
+        self.start()
+        return self._snapshot
+
+    async def ready(self):
+        self.start()
+        await self._loaded.wait()
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._run(name)) for name in self.names]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _request(self, url: str, **kwargs) -> tornado.httpclient.HTTPRequest:
+        headers = {'Accept': 'application/json'}
+        if self.token_file is not None:
+            # bound service account tokens are rotated, so the file is read again for every request
+            headers['Authorization'] = f'Bearer {self.token_file.read_text().strip()}'
+        return tornado.httpclient.HTTPRequest(url, headers=headers,
+                                              ca_certs=str(self.ca_file) if self.ca_file is not None else None,
+                                              **kwargs)
+
+    def _url(self, name: str, **params) -> str:
+        query = tornado.httputil.url_concat('', {'fieldSelector': f'metadata.name={name}', **params})
+        return f'{self.api_url}/api/v1/namespaces/{self.namespace}/configmaps{query}'
+
+    async def _run(self, name: str):
+        # the watch keeps its connection open, so it gets its own client instead of the shared one
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        try:
+            while True:
                 try:
-                    data = json.load(open(json_file, 'r'))
-                    matches = query.search(data)
-                    if matches:
-                        response[json_file.name] = matches
-                except json.decoder.JSONDecodeError:
-                    log.warning(f"Failed to load JSON from file {json_file}")
+                    if name not in self.resource_versions:
+                        await self._list(client, name)
+                    await self._watch(client, name)
+                except WatchExpired:
+                    log.info(f"Config map '{name}' changed too much since the last event, listing it again")
+                    del self.resource_versions[name]
                 except Exception as e:
-                    log.exception(f"Error processing file {json_file}: {e}")
+                    log.warning(f"Watching config map '{name}' failed: {e}")
+                    await asyncio.sleep(self.retry_delay)
+        finally:
+            client.close()
+
+    async def _list(self, client: tornado.httpclient.AsyncHTTPClient, name: str):
+        response = await client.fetch(self._request(self._url(name)))
+        config_maps = json.loads(response.body)
+        items = config_maps.get('items') or []
+        if not items:
+            log.warning(f"Config map '{name}' not found in namespace '{self.namespace}'")
+        self._apply(name, (items[0].get('data') or {}) if items else {}, config_maps['metadata']['resourceVersion'])
+
+    async def _watch(self, client: tornado.httpclient.AsyncHTTPClient, name: str):
+        buffer = bytearray()
+        expired = False
+
+        def on_chunk(chunk: bytes):
+            nonlocal expired
+            buffer.extend(chunk)
+            *lines, rest = buffer.split(b'\n')
+            buffer[:] = rest
+            for line in lines:
+                if line.strip() and not expired:
+                    expired = not self._on_event(name, json.loads(line))
+
+        url = self._url(name, watch='true', resourceVersion=self.resource_versions[name], allowWatchBookmarks='true',
+                        timeoutSeconds=self.watch_timeout)
+        await client.fetch(self._request(url, request_timeout=self.watch_timeout + 30, streaming_callback=on_chunk))
+        if expired:
+            raise WatchExpired()
+
+    def _on_event(self, name: str, event: dict) -> bool:
+        """Apply a watch event. Returns False if the watch has to be started again from a fresh list."""
+        obj = event['object']
+        if event['type'] == 'ERROR':
+            if obj.get('code') == 410:
+                return False
+            raise tornado.httpclient.HTTPClientError(obj.get('code', 500), obj.get('message'))
+        resource_version = obj['metadata']['resourceVersion']
+        if event['type'] == 'BOOKMARK':
+            self.resource_versions[name] = resource_version
+        elif event['type'] == 'DELETED':
+            log.warning(f"Config map '{name}' was deleted")
+            self._apply(name, {}, resource_version)
+        else:
+            self._apply(name, obj.get('data') or {}, resource_version)
+        return True
+
+    def _apply(self, name: str, data: dict[str, str], resource_version: str):
+        self.resource_versions[name] = resource_version
+        if self._texts.get(name) == data and self._loaded.is_set():
+            return
+        previous_texts = {key: text for texts in self._texts.values() for key, text in texts.items()}
+        self._texts[name] = dict(data)
+        if len(self._texts) < len(self.names):
+            return  # wait for the first list of all shards
+        previous = self._snapshot
+        entries = {}
+        for shard in self.names:
+            for key, text in self._texts[shard].items():
+                # values that did not change keep their entry, including the encoded variants cached on it
+                entry = previous.entries.get(key) if previous_texts.get(key) == text else None
+                if entry is None:
+                    entry = ConfigEntry.from_text(text)
+                    if entry.error is not None:
+                        log.warning(f"Failed to load JSON of key {key}")
+                entries[key] = entry
+        try:
+            generation = max(int(resource_version), previous.generation + 1)
+        except ValueError:
+            # resourceVersions are opaque, they are only numbers in practice
+            generation = previous.generation + 1
+        snapshot = ConfigSnapshot(entries, generation)
+        self._snapshot = snapshot
+        self.source_changed = time.time()
+        self._loaded.set()
+        self._notify(previous, snapshot)
+
+
+def changed_keys(old: ConfigSnapshot, new: ConfigSnapshot) -> frozenset[str]:
+    changed = set()
+    for key in old.entries.keys() | new.entries.keys():
+        old_entry, new_entry = old.entries.get(key), new.entries.get(key)
+        if old_entry is None or new_entry is None or (old_entry.etag, old_entry.error) != (new_entry.etag,
+                                                                                            new_entry.error):
+            changed.add(key)
+    return frozenset(changed)
+
+
+class ChangeFeed:
+    """Records which keys changed in recent snapshot generations and wakes up watchers when a new one arrives.
+
+    The config directory is polled by a single periodic callback that is started with the first watcher, so idle
+    watchers do not cost anything besides their connection.
+    """
+
+    def __init__(self, store: SnapshotStore, poll_interval: float = 1.0, history: int = 1024):
+        self.store = store
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._history: deque[tuple[int, int, frozenset[str]]] = deque(maxlen=history)
+        self._condition = tornado.locks.Condition()
+        self._io_loop: tornado.ioloop.IOLoop | None = None
+        self._poller: tornado.ioloop.PeriodicCallback | None = None
+        store.listeners.append(self._on_snapshot)
+
+    def _on_snapshot(self, old: ConfigSnapshot, new: ConfigSnapshot):
+        with self._lock:
+            self._history.append((old.generation, new.generation, changed_keys(old, new)))
+        if self._io_loop is not None:
+            # snapshots may be installed from other threads, the condition has to be notified on the IOLoop
+            self._io_loop.add_callback(self._condition.notify_all)
+
+    def _ensure_polling(self):
+        if self._poller is None:
+            self._io_loop = tornado.ioloop.IOLoop.current()
+            self._poller = tornado.ioloop.PeriodicCallback(self.store.current, self.poll_interval * 1000)
+            self._poller.start()
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def changes_since(self, generation: int) -> frozenset[str] | None:
+        """Keys that changed after ``generation``, or None if the history does not reach back far enough."""
+        current = self.store.snapshot.generation
+        if generation == current:
+            return frozenset()
+        with self._lock:
+            if generation > current or not self._history or self._history[0][0] > generation:
+                return None
+            changed = set()
+            # with shared snapshots a worker may skip generations, then changes are reported relative to the
+            # last snapshot it has seen
+            for _, gen, keys in self._history:
+                if gen > generation:
+                    changed.update(keys)
+            return frozenset(changed)
+
+    async def wait(self, generation: int, deadline: float) -> bool:
+        """Wait until a snapshot newer than ``generation`` is installed. Returns False if the deadline (in IOLoop
+        time) passed."""
+        self._ensure_polling()
+        while self.store.snapshot.generation <= generation:
+            if not await self._condition.wait(timeout=deadline):
+                return False
+        return True
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(expression: str) -> jmespath.parser.ParsedResult:
+    return jmespath.compile(expression)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_matches(snapshot: ConfigSnapshot, query: jmespath.parser.ParsedResult, keys: Iterable[str],
+                  limit: int | None = None, timeout: float | None = None, max_bytes: int | None = None,
+                  deadline: float | None = None) -> tuple[list[tuple[str, bytes]], int]:
+    """Run ``query`` against the values of ``keys`` in order, until ``limit`` of them matched.
+
+    Returns the keys with a match and their encoded matches, and the number of keys that were scanned. Raises
+    :class:`QueryBudgetExceeded` if the evaluation takes longer than ``timeout`` seconds or the encoded matches grow
+    beyond ``max_bytes``. A ``deadline`` (in :func:`time.monotonic` time) replaces the one derived from ``timeout``
+    when one time budget is shared by several calls.
+    """
+    if deadline is None and timeout is not None:
+        deadline = time.monotonic() + timeout
+    results, size, scanned = [], 2, 0
+    for key in keys:
+        if limit is not None and len(results) >= limit:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise QueryBudgetExceeded(f"Query exceeded the time budget of {timeout}s")
+        scanned += 1
+        entry = snapshot.entries[key]
+        if entry.error is not None:
+            continue
+        try:
+            matches = query.search(entry.value)
+            if matches:
+                encoded = tornado.escape.json_encode(matches).encode()
+                size += len(tornado.escape.json_encode(key)) + len(encoded) + 2
+                if max_bytes is not None and size > max_bytes:
+                    raise QueryBudgetExceeded(f"Query result exceeds the limit of {max_bytes} bytes")
+                results.append((key, encoded))
+        except QueryBudgetExceeded:
+            raise
+        except Exception as e:
+            log.exception(f"Error processing key {key}: {e}")
+    return results, scanned
 
-        self.write(response)
 
+def _encode_matches(matches: list[tuple[str, bytes]]) -> bytes:
+    return b"{" + b",".join(tornado.escape.json_encode(key).encode() + b":" + encoded
+                            for key, encoded in matches) + b"}"
 
-def make_app(config_values: Path) -> tornado.web.Application:
-    return tornado.web.Application(
-        handlers=[
-            (r"/config(?:/(?P<key>[\d\w.-]+))?/?", KeyValueHandler)
-        ],
+
+def evaluate_query(snapshot: ConfigSnapshot, query: jmespath.parser.ParsedResult,
+                   timeout: float | None = None, max_bytes: int | None = None,
+                   keys: list[str] | None = None) -> tuple[bytes, int]:
+    """Run ``query`` against every value of the snapshot (or only those of ``keys``) and return the encoded
+    ``{key: matches}`` object and the number of keys that were scanned.
+
+    Raises :class:`QueryBudgetExceeded` if the evaluation takes longer than ``timeout`` seconds or the encoded result
+    grows beyond ``max_bytes``.
+    """
+    keys = keys if keys is not None else snapshot.entries
+    matches, scanned = query_matches(snapshot, query, keys, timeout=timeout, max_bytes=max_bytes)
+    return _encode_matches(matches), scanned
+
+
+def evaluate_query_page(snapshot: ConfigSnapshot, query: jmespath.parser.ParsedResult, after: str | None,
+                        limit: int | None, timeout: float | None = None, max_bytes: int | None = None,
+                        keys: list[str] | None = None) -> tuple[bytes, int]:
+    """Matches of ``query`` for the keys that sort after ``after``, at most ``limit`` of them.
+
+    Returns the encoded ``{"values": {key: matches}, "next": cursor}`` object and the number of keys that were
+    scanned. ``next`` is the ``after`` of the
+    following page, or null if all keys were scanned. ``keys`` restricts the scan to some of the sorted keys.
+    """
+    keys = keys if keys is not None else snapshot.sorted_keys
+    start = bisect.bisect_right(keys, after) if after is not None else 0
+    matches, scanned = query_matches(snapshot, query, itertools.islice(keys, start, None), limit, timeout, max_bytes)
+    end = start + scanned
+    cursor = keys[end - 1] if end < len(keys) else None
+    body = b'{"values":' + _encode_matches(matches) + b',"next":' + tornado.escape.json_encode(cursor).encode() + b'}'
+    return body, scanned
+
+
+def _field_path(node: dict) -> tuple[str, ...] | None:
+    """Names of a ``a.b.c`` field expression, or None for any other expression."""
+    if node['type'] == 'field':
+        return (node['value'],)
+    if node['type'] == 'subexpression':
+        paths = [_field_path(child) for child in node['children']]
+        if all(path is not None for path in paths):
+            return sum(paths, ())
+    return None
+
+
+def query_conditions(node: dict) -> list[tuple[tuple[str, ...], object]]:
+    """Conditions ``field == literal`` (with scalar literals) that have to hold for the result of a query to be
+    truthy, taken from the top level of its AST and of ``&&`` expressions."""
+    if node['type'] == 'and_expression':
+        return query_conditions(node['children'][0]) + query_conditions(node['children'][1])
+    if node['type'] == 'comparator' and node['value'] == 'eq':
+        left, right = node['children']
+        if left['type'] == 'literal':
+            left, right = right, left
+        path = _field_path(left)
+        if path is not None and right['type'] == 'literal' and _index_key(right['value']) is not None:
+            # paths are kept as tuples, a quoted name like "a.b" is not the nested field a.b
+            return [(path, right['value'])]
+    return []
+
+
+def _index_key(value) -> tuple[bool, object] | None:
+    # JMESPath does not consider true equal to 1, so booleans are kept apart from numbers
+    if value is None or isinstance(value, (str, int, float)):
+        return isinstance(value, bool), value
+    return None
+
+
+class SnapshotIndex:
+    """Inverted indexes from the values of some fields to the (sorted) keys whose values hold them.
+
+    Fields are dotted paths into the values. Keys whose value does not have a field are indexed under null, like
+    JMESPath evaluates them; lists and objects are not indexed.
+    """
+
+    def __init__(self, snapshot: ConfigSnapshot, fields: Iterable[str], previous: 'SnapshotIndex | None' = None):
+        self.snapshot = snapshot
+        self.fields = tuple(fields)
+        self.keys: dict[str, dict[tuple[bool, object], list[str]]] = {field: {} for field in self.fields}
+        # indexed values of each key, reused by the index of the next snapshot for values with the same ETag
+        self._values: dict[str, tuple[str, tuple]] = {}
+        paths = [tuple(field.split('.')) for field in self.fields]
+        known = previous._values if previous is not None and previous.fields == self.fields else {}
+        for key in snapshot.sorted_keys:
+            entry = snapshot.entries[key]
+            if entry.error is not None:
+                continue
+            etag, values = known.get(key, (None, None))
+            if etag != entry.etag:
+                values = tuple(_index_key(_lookup_field(entry.value, path)) for path in paths)
+            self._values[key] = (entry.etag, values)
+            for field, value in zip(self.fields, values):
+                if value is not None:
+                    self.keys[field].setdefault(value, []).append(key)
+
+    def lookup(self, conditions: Iterable[tuple[str, object]]) -> list[str]:
+        """Sorted keys whose values match all ``(field, value)`` conditions."""
+        matches = sorted((self.keys[field].get(_index_key(value), []) for field, value in conditions), key=len)
+        if not matches:
+            return []
+        others = [set(keys) for keys in matches[1:]]
+        return [key for key in matches[0] if all(key in other for other in others)]
+
+
+def _lookup_field(value, path: tuple[str, ...]):
+    for name in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def prefix_keys(snapshot: ConfigSnapshot, prefix: str) -> list[str]:
+    """Sorted keys that start with ``prefix``, found by bisecting the sorted keys of the snapshot."""
+    keys = snapshot.sorted_keys
+    start = bisect.bisect_left(keys, prefix)
+    end = start
+    while end < len(keys) and keys[end].startswith(prefix):
+        end += 1
+    return keys[start:end]
+
+
+class FieldIndexes:
+    """Builds the :class:`SnapshotIndex` of the current snapshot on the executor.
+
+    The index is built once per snapshot, when it is first needed. Values whose ETag did not change since the
+    previous snapshot are not parsed again.
+    """
+
+    def __init__(self, fields: Iterable[str] = (), executor: concurrent.futures.Executor | None = None):
+        self.fields = tuple(dict.fromkeys(fields))
+        self.paths = {tuple(field.split('.')): field for field in self.fields}
+        self.executor = executor
+        self._index: SnapshotIndex | None = None
+        self._pending: tuple[ConfigSnapshot, asyncio.Future] | None = None
+
+    async def get(self, snapshot: ConfigSnapshot) -> SnapshotIndex:
+        if self._index is not None and self._index.snapshot is snapshot:
+            return self._index
+        # concurrent requests for the same snapshot share a single build
+        if self._pending is None or self._pending[0] is not snapshot:
+            self._pending = (snapshot, asyncio.get_running_loop().run_in_executor(
+                self.executor, SnapshotIndex, snapshot, self.fields, self._index))
+        index = await asyncio.shield(self._pending[1])
+        if self._index is None or self._index.snapshot.generation <= snapshot.generation:
+            self._index = index
+        return index
+
+
+class ResponseCache:
+    """LRU cache of encoded responses and their ETags.
+
+    Keys include the snapshot generation or the ETag of the value the response was computed from, so entries that
+    belong to an outdated snapshot are never hit again and are evicted as new responses come in.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results: OrderedDict[tuple, tuple[bytes, str]] = OrderedDict()
+
+    def get(self, key: tuple) -> tuple[bytes, str] | None:
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self.hits += 1
+                self._results.move_to_end(key)
+            else:
+                self.misses += 1
+            return result
+
+    def put(self, key: tuple, result: tuple[bytes, str]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+
+def resolve_pointer(value, pointer: str):
+    """Resolve a JSON Pointer (RFC 6901) like ``/db/pool/size`` against a parsed value.
+
+    Raises :class:`LookupError` if the pointer does not exist in the value.
+    """
+    for token in pointer.split('/')[1:]:
+        token = token.replace('~1', '/').replace('~0', '~')
+        if isinstance(value, dict):
+            value = value[token]
+        elif isinstance(value, list) and token.isdigit():
+            value = value[int(token)]
+        else:
+            raise LookupError(token)
+    return value
+
+
+class SnapshotCollector(prometheus_client.registry.Collector):
+    """Reports the state of the snapshot store and the response caches at scrape time."""
+
+    def __init__(self, store: SnapshotStore, caches: dict[str, ResponseCache]):
+        self.store = store
+        self.caches = caches
+
+    def collect(self):
+        snapshot = self.store.snapshot
+        now = time.time()
+        yield GaugeMetricFamily('config_server_snapshot_keys', 'Number of keys in the current snapshot',
+                                value=len(snapshot))
+        yield GaugeMetricFamily('config_server_snapshot_bytes', 'Size of the encoded values of the current snapshot',
+                                value=snapshot.size)
+        yield GaugeMetricFamily('config_server_snapshot_generation', 'Generation of the current snapshot',
+                                value=snapshot.generation)
+        yield GaugeMetricFamily('config_server_snapshot_age_seconds', 'Seconds since the current snapshot was loaded',
+                                value=now - snapshot.created)
+        yield GaugeMetricFamily('config_server_source_change_age_seconds',
+                                'Seconds since the config directory (config map volume) last changed',
+                                value=now - self.store.source_changed)
+
+        lookups = CounterMetricFamily('config_server_cache_lookups', 'Lookups in the response caches',
+                                      labels=['cache', 'result'])
+        for name, cache in self.caches.items():
+            lookups.add_metric([name, 'hit'], cache.hits)
+            lookups.add_metric([name, 'miss'], cache.misses)
+        yield lookups
+
+
+class ServerMetrics:
+    """Prometheus metrics of one application. Every application uses its own registry.
+
+    Worker processes (``--workers``) share the port of the API, so each of them serves its metrics on its own port
+    (``--metrics-port`` plus the worker number) and has to be scraped as a separate target.
+    """
+
+    def __init__(self, store: SnapshotStore, caches: dict[str, ResponseCache]):
+        self.registry = prometheus_client.CollectorRegistry()
+        self.request_duration = prometheus_client.Histogram(
+            'config_server_request_duration_seconds', 'Time spent handling requests',
+            ['route', 'method'], registry=self.registry)
+        self.responses = prometheus_client.Counter(
+            'config_server_responses', 'Responses by status code', ['route', 'method', 'code'],
+            registry=self.registry)
+        self.response_bytes = prometheus_client.Counter(
+            'config_server_response_bytes', 'Bytes of response bodies written', ['route'], registry=self.registry)
+        self.query_duration = prometheus_client.Histogram(
+            'config_server_query_duration_seconds', 'Time spent evaluating JMESPath queries (cache misses only)',
+            registry=self.registry)
+        self.query_keys_scanned = prometheus_client.Histogram(
+            'config_server_query_keys_scanned', 'Number of keys a JMESPath query was evaluated against',
+            buckets=(1, 10, 100, 1000, 10000, 100000, float('inf')), registry=self.registry)
+        self.registry.register(SnapshotCollector(store, caches))
+
+    def observe_request(self, handler: tornado.web.RequestHandler):
+        route = getattr(handler, 'route', 'other')
+        method = handler.request.method
+        self.request_duration.labels(route, method).observe(handler.request.request_time())
+        self.responses.labels(route, method, str(handler.get_status())).inc()
+        self.response_bytes.labels(route).inc(getattr(handler, 'bytes_written', 0))
+
+
+class ConfigServerApplication(tornado.web.Application):
+    def log_request(self, handler: tornado.web.RequestHandler):
+        super().log_request(handler)
+        self.settings['metrics'].observe_request(handler)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    route = 'metrics'
+
+    def get(self):
+        self.set_header("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)
+        self.write(prometheus_client.generate_latest(self.settings['metrics'].registry))
+
+
+JSON_MEDIA_TYPE = "application/json"
+MEDIA_TYPES: dict[str, Callable[[object], bytes]] = {}
+if msgpack is not None:
+    MEDIA_TYPES["application/msgpack"] = functools.partial(msgpack.packb, use_bin_type=True)
+    MEDIA_TYPES["application/x-msgpack"] = MEDIA_TYPES["application/msgpack"]
+if cbor2 is not None:
+    MEDIA_TYPES["application/cbor"] = cbor2.dumps
+
+CONTENT_CODINGS: dict[str, Callable[[bytes], bytes]] = {"gzip": functools.partial(gzip.compress, mtime=0)}
+if brotli is not None:
+    CONTENT_CODINGS["br"] = functools.partial(brotli.compress, quality=9)
+# smaller bodies are not worth the compression
+COMPRESS_MIN_SIZE = 1024
+
+
+def parse_accept(header: str | None) -> list[str]:
+    """Values of an Accept-style header ordered by their quality, without the ones that are not acceptable."""
+    if not header:
+        return []
+    values = []
+    for position, item in enumerate(header.split(',')):
+        value, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, number = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        if value and quality > 0:
+            values.append((-quality, position, value.lower()))
+    return [value for _, _, value in sorted(values)]
+
+
+def negotiate_media_type(accept: str | None) -> str:
+    """Preferred media type of the client, JSON if it accepts anything or nothing we can produce."""
+    for media_type in parse_accept(accept):
+        if media_type in MEDIA_TYPES or media_type in (JSON_MEDIA_TYPE, "*/*", "application/*"):
+            return media_type if media_type in MEDIA_TYPES else JSON_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def negotiate_coding(accept_encoding: str | None) -> str | None:
+    for coding in parse_accept(accept_encoding):
+        if coding in CONTENT_CODINGS:
+            return coding
+        if coding == 'identity':
+            return None
+    return None
+
+
+def encode_variant(body: bytes, media_type: str, coding: str | None) -> bytes:
+    if media_type != JSON_MEDIA_TYPE:
+        body = MEDIA_TYPES[media_type](json.loads(body))
+    if coding is not None:
+        body = CONTENT_CODINGS[coding](body)
+    return body
+
+
+class SnapshotHandler(tornado.web.RequestHandler):
+    snapshot: ConfigSnapshot | None = None
+    bytes_written = 0
+
+    async def prepare(self):
+        # use a single snapshot for the whole request
+        self.snapshot = await self.settings['config_store'].current()
+        self.set_default_headers()
+
+    def write(self, chunk: str | bytes):
+        super().write(chunk)
+        self.bytes_written += len(tornado.escape.utf8(chunk))
+
+    def set_default_headers(self):
+        if self.snapshot is not None:
+            self.set_header("X-Config-Generation", str(self.snapshot.generation))
+            self.set_header("X-Config-Version", self.snapshot.version)
+
+    async def write_response(self, body: bytes, etag: str, variants: dict | None = None):
+        """Write a pre-encoded JSON body in the media type and content coding negotiated with the client, or an empty
+        304 response if the client already has this version."""
+        body, etag = await self.negotiate_response(body, etag, variants)
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(body)
+
+    async def negotiate_response(self, body: bytes, etag: str,
+                                 variants: dict | None = None) -> tuple[bytes, str]:
+        """Body and ETag of a pre-encoded JSON body in the media type and content coding negotiated with the client,
+        and set the matching headers.
+
+        Other representations are encoded on the executor and kept in ``variants`` (or the application's variant
+        cache), so they are not encoded again for the next request.
+        """
+        media_type = negotiate_media_type(self.request.headers.get('Accept'))
+        coding = negotiate_coding(self.request.headers.get('Accept-Encoding'))
+        if coding is not None and len(body) < COMPRESS_MIN_SIZE:
+            coding = None
+        self.set_header("Vary", "Accept, Accept-Encoding")
+
+        if (media_type, coding) != (JSON_MEDIA_TYPE, None):
+            cache: ResponseCache = self.settings['variant_cache']
+            result = variants.get((media_type, coding)) if variants is not None else cache.get(
+                (etag, media_type, coding))
+            if result is None:
+                encoded = await asyncio.get_running_loop().run_in_executor(
+                    self.settings['executor'], encode_variant, body, media_type, coding)
+                suffix = ".".join(filter(None, [media_type.rsplit('/', 1)[-1], coding]))
+                result = (encoded, f'{etag[:-1]}-{suffix}"')
+                if variants is not None:
+                    variants[(media_type, coding)] = result
+                else:
+                    cache.put((etag, media_type, coding), result)
+            body, etag = result
+
+        if media_type == JSON_MEDIA_TYPE:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        else:
+            self.set_header("Content-Type", media_type)
+        if coding is not None:
+            self.set_header("Content-Encoding", coding)
+        return body, etag
+
+    def compile_query(self, expression: str) -> jmespath.parser.ParsedResult:
+        try:
+            return compile_query(expression)
+        except jmespath.exceptions.JMESPathError as e:
+            raise tornado.web.HTTPError(400, reason=f"Invalid query '{expression}': {e}")
+
+    async def indexed_keys(self, query: jmespath.parser.ParsedResult) -> list[str] | None:
+        """Sorted keys a query can match according to the field indexes, or None if it has to scan all keys."""
+        indexes: FieldIndexes = self.settings['field_indexes']
+        conditions = [(indexes.paths[path], value) for path, value in query_conditions(query.parsed)
+                      if path in indexes.paths]
+        if not conditions:
+            return None
+        return (await indexes.get(self.snapshot)).lookup(conditions)
+
+    async def query_result(self, expression: str, after: str | None = None,
+                           limit: int | None = None) -> tuple[bytes, str]:
+        """Encoded result and ETag of a JMESPath query against the current snapshot.
+
+        Queries are evaluated on the executor within the configured time and size budgets. With ``after`` or
+        ``limit``, only one page of the result is returned (see :func:`evaluate_query_page`).
+        """
+        query = self.compile_query(expression)
+
+        cache: ResponseCache = self.settings['query_cache']
+        snapshot = self.snapshot
+        result = cache.get((expression, snapshot.generation, after, limit))
+        if result is None:
+            keys = await self.indexed_keys(query)
+            metrics: ServerMetrics = self.settings['metrics']
+            if after is None and limit is None:
+                evaluate = functools.partial(evaluate_query, snapshot, query, keys=keys)
+            else:
+                evaluate = functools.partial(evaluate_query_page, snapshot, query, after, limit, keys=keys)
+            try:
+                with metrics.query_duration.time():
+                    body, scanned = await asyncio.get_running_loop().run_in_executor(
+                        self.settings['executor'], evaluate, self.settings['query_timeout'],
+                        self.settings['query_max_bytes'])
+            except QueryBudgetExceeded as e:
+                raise tornado.web.HTTPError(422, reason=str(e))
+            metrics.query_keys_scanned.observe(scanned)
+            result = (body, content_etag(body))
+            cache.put((expression, snapshot.generation, after, limit), result)
+        return result
+
+
+KEY_PATTERN = r"[\d\w.-]+"
+
+
+def batch_result(snapshot: ConfigSnapshot, keys: list[str]) -> tuple[bytes, str]:
+    """Encoded values of several keys from one snapshot, reporting missing and invalid keys individually.
+
+    The response is assembled from the pre-encoded value bodies, so no value is encoded again.
+    """
+    values, errors, etags = [], {}, []
+    for key in dict.fromkeys(keys):
+        entry = snapshot.entries.get(key)
+        if not re.fullmatch(KEY_PATTERN, key):
+            errors[key] = {"status": 400, "reason": f"Invalid key '{key}'"}
+        elif entry is None:
+            errors[key] = {"status": 404, "reason": f"Key '{key}' not found"}
+        elif entry.error is not None:
+            errors[key] = {"status": 400, "reason": f"Failed to load values for key '{key}': {entry.error}"}
+        else:
+            values.append(tornado.escape.json_encode(key).encode() + b":" + entry.body)
+            etags.append(f"{key}={entry.etag}")
+    body = b'{"values":{' + b",".join(values) + b'},"errors":' + tornado.escape.json_encode(errors).encode() + b'}'
+    return body, content_etag(";".join(etags).encode() + tornado.escape.json_encode(errors).encode())
+
+
+class KeyValueHandler(SnapshotHandler):
+    route = 'config'
+    # keys evaluated per executor call of a streamed query, bounds the matches held in memory
+    stream_chunk_size = 256
+
+    async def get(self, key: str = None, path: str = None):
+        if key is None and self.get_query_argument('keys', None):
+            await self.write_response(*batch_result(self.snapshot, self.get_query_argument('keys').split(',')))
+            return
+        if key is None:
+            # cheap check whether anything changed since a client's last request
+            await self.write_response(json.dumps({"generation": self.snapshot.generation,
+                                                  "version": self.snapshot.version}).encode(),
+                                      f'"{self.snapshot.version}"')
+            return
+
+        entry = self.snapshot.entries.get(key)
+        if entry is None:
+            raise tornado.web.HTTPError(404, reason=f"Key '{key}' not found")
+        if entry.error is not None:
+            raise tornado.web.HTTPError(400, reason=f"Failed to load values for key '{key}': {entry.error}")
+        if path is None:
+            await self.write_response(entry.body, entry.etag, entry.variants)
+            return
+
+        # sub-documents are cached per value ETag, so they survive reloads that do not touch this key
+        cache: ResponseCache = self.settings['path_cache']
+        result = cache.get((key, path, entry.etag))
+        if result is None:
+            try:
+                body = tornado.escape.json_encode(resolve_pointer(entry.value, path)).encode()
+            except LookupError:
+                raise tornado.web.HTTPError(404, reason=f"Path '{path}' not found in key '{key}'")
+            result = (body, content_etag(body))
+            cache.put((key, path, entry.etag), result)
+        await self.write_response(*result)
+
+    async def head(self, key: str = None, path: str = None):
+        # Tornado drops the body of HEAD responses but keeps Content-Length and ETag
+        await self.get(key, path)
+
+    async def post(self, key: str = None, path: str = None):
+        try:
+            body = json.loads(self.request.body)
+        except json.decoder.JSONDecodeError:
+            raise tornado.web.HTTPError(400, reason="Request body is not valid JSON")
+
+        if 'keys' in body:
+            keys = body['keys']
+            if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+                raise tornado.web.HTTPError(400, reason="'keys' has to be a list of strings")
+            await self.write_response(*batch_result(self.snapshot, keys))
+            return
+        if 'where' in body or 'prefix' in body:
+            await self.write_response(*batch_result(self.snapshot, await self.lookup_keys(body)))
+            return
+
+        after, limit = body.get('after'), body.get('limit')
+        if after is not None and not isinstance(after, str):
+            raise tornado.web.HTTPError(400, reason="'after' has to be a key")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+            raise tornado.web.HTTPError(400, reason="'limit' has to be a positive integer")
+        if 'application/x-ndjson' in self.request.headers.get('Accept', ''):
+            await self.stream_query(body.get('query', '*'), after, limit)
+            return
+        await self.write_response(*await self.query_result(body.get('query', '*'), after, limit))
+
+    async def lookup_keys(self, body: dict) -> list[str]:
+        """Keys selected by a lookup: ``where`` maps indexed fields to the values they have to equal, ``prefix``
+        restricts the key names."""
+        where, prefix = body.get('where', {}), body.get('prefix')
+        if not isinstance(where, dict) or any(_index_key(value) is None for value in where.values()):
+            raise tornado.web.HTTPError(400, reason="'where' has to map fields to strings, numbers, booleans or null")
+        if prefix is not None and not isinstance(prefix, str):
+            raise tornado.web.HTTPError(400, reason="'prefix' has to be a string")
+        indexes: FieldIndexes = self.settings['field_indexes']
+        for field in where:
+            if field not in indexes.fields:
+                raise tornado.web.HTTPError(400, reason=f"Field '{field}' is not indexed")
+
+        if not where:
+            return prefix_keys(self.snapshot, prefix or '')
+        keys = (await indexes.get(self.snapshot)).lookup(where.items())
+        if prefix is not None:
+            keys = [key for key in keys if key.startswith(prefix)]
+        return keys
+
+    async def stream_query(self, expression: str, after: str | None, limit: int | None):
+        """Write the matches of a query as newline delimited JSON objects while the keys are evaluated.
+
+        Each line is ``{"key": ..., "value": ...}``. Keys are evaluated in sorted order and in chunks, so only the
+        matches of one chunk are held in memory. If ``limit`` stops the stream early, the last line is
+        ``{"next": cursor}``. A query that exceeds the time budget after the first lines were sent ends with an
+        ``{"error": ...}`` line.
+        """
+        query = self.compile_query(expression)
+        snapshot = self.snapshot
+        keys = await self.indexed_keys(query)
+        if keys is None:
+            keys = snapshot.sorted_keys
+        position = bisect.bisect_right(keys, after) if after is not None else 0
+        remaining = limit
+        # the time budget covers the evaluation of all chunks, but not the time spent sending them to the client
+        timeout, evaluated = self.settings['query_timeout'], 0.0
+        metrics: ServerMetrics = self.settings['metrics']
+        self.set_header("Content-Type", "application/x-ndjson")
+        flushed, keys_scanned = False, 0
+        try:
+            while position < len(keys) and remaining != 0:
+                chunk = keys[position:position + self.stream_chunk_size]
+                started = time.monotonic()
+                deadline = started + timeout - evaluated if timeout is not None else None
+                try:
+                    with metrics.query_duration.time():
+                        matches, scanned = await asyncio.get_running_loop().run_in_executor(
+                            self.settings['executor'], functools.partial(
+                                query_matches, snapshot, query, chunk, remaining, timeout, deadline=deadline))
+                except QueryBudgetExceeded as e:
+                    if not flushed:
+                        raise tornado.web.HTTPError(422, reason=str(e))
+                    self.write(tornado.escape.json_encode({"error": str(e)}) + "\n")
+                    return
+                evaluated += time.monotonic() - started
+                keys_scanned += scanned
+                position += scanned
+                if remaining is not None:
+                    remaining -= len(matches)
+                for key, encoded in matches:
+                    self.write(b'{"key":' + tornado.escape.json_encode(key).encode() + b',"value":' + encoded + b'}\n')
+                await self.flush()
+                flushed = True
+            if position < len(keys):
+                self.write(tornado.escape.json_encode({"next": keys[position - 1]}) + "\n")
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            metrics.query_keys_scanned.observe(keys_scanned)
+
+
+class WatchHandler(SnapshotHandler):
+    """Long-poll and Server-Sent Events endpoint that reports changes of the config.
+
+    Key watches (optionally restricted with ``keys=a,b``) use ``since=<generation>`` as cursor and return the values
+    of all keys that changed after that generation. Query watches (``query=<expression>``) return the query result
+    as soon as its ETag differs from ``If-None-Match``. With ``Accept: text/event-stream`` the connection stays open
+    and every change is sent as an event.
+    """
+    route = 'watch'
+    max_timeout = 300.0
+    heartbeat_interval = 15.0
+
+    async def prepare(self):
+        await super().prepare()
+        self.feed: ChangeFeed = self.settings['change_feed']
+        self.keys = None
+        if self.get_query_argument('keys', None):
+            self.keys = set(self.get_query_argument('keys').split(','))
+        self.query = self.get_query_argument('query', None)
+        try:
+            self.timeout = min(float(self.get_query_argument('timeout', '30')), self.max_timeout)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Invalid timeout")
+
+    def key_changes(self, since: int) -> dict | None:
+        changed = self.feed.changes_since(since)
+        resync = changed is None
+        if resync:
+            changed = self.snapshot.entries.keys()
+        if self.keys is not None:
+            changed = self.keys.intersection(changed)
+        if not changed and not resync:
+            return None
+
+        values, deleted = {}, []
+        for key in sorted(changed):
+            entry = self.snapshot.entries.get(key)
+            if entry is None or entry.error is not None:
+                deleted.append(key)
+            else:
+                values[key] = entry.value
+        return {"generation": self.snapshot.generation, "version": self.snapshot.version, "resync": resync,
+                "changed": values, "deleted": deleted}
+
+    async def get(self):
+        try:
+            since = int(self.get_query_argument('since', self.request.headers.get('Last-Event-ID', '0')))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Invalid generation")
+        if self.query is not None:
+            await self.query_result(self.query)  # reject invalid queries before waiting
+
+        if 'text/event-stream' in self.request.headers.get('Accept', ''):
+            await self.stream_events(since)
+        else:
+            await self.long_poll(since)
+
+    async def long_poll(self, since: int):
+        deadline = tornado.ioloop.IOLoop.current().time() + self.timeout
+        while True:
+            if self.query is not None:
+                # clients hold the ETag of the representation they negotiated, not that of the JSON result
+                body, etag = await self.negotiate_response(*await self.query_result(self.query))
+                self.set_header("Etag", etag)
+                if not self.check_etag_header():
+                    self.write(body)
+                    return
+            else:
+                changes = self.key_changes(since)
+                if changes is not None:
+                    self.set_header("Content-Type", "application/json; charset=UTF-8")
+                    self.write(tornado.escape.json_encode(changes))
+                    return
+
+            since = self.snapshot.generation
+            if not await self.feed.wait(since, deadline):
+                # nothing changed in time, the client should poll again
+                self.set_status(304)
+                return
+            self.snapshot = self.settings['config_store'].snapshot
+            self.set_default_headers()
+
+    async def stream_events(self, since: int):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        etag = self.request.headers.get('If-None-Match')
+        try:
+            while True:
+                self.snapshot = self.settings['config_store'].snapshot
+                if self.query is not None:
+                    body, result_etag = await self.query_result(self.query)
+                    if result_etag != etag:
+                        etag = result_etag
+                        self.write(f"id: {self.snapshot.generation}\nevent: result\ndata: ".encode() + body + b"\n\n")
+                else:
+                    changes = self.key_changes(since)
+                    if changes is not None:
+                        data = tornado.escape.json_encode(changes)
+                        self.write(f"id: {self.snapshot.generation}\nevent: change\ndata: {data}\n\n")
+                since = self.snapshot.generation
+
+                await self.flush()
+                if not await self.feed.wait(since, tornado.ioloop.IOLoop.current().time() + self.heartbeat_interval):
+                    self.write(": heartbeat\n\n")
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+def make_app(config_values: Path, reload_interval: float = 0.0, query_cache_size: int = 256, query_workers: int = 4,
+             query_timeout: float = 5.0, query_max_bytes: int = 16 * 1024 * 1024,
+             snapshot_dir: Path | None = None, path_cache_size: int = 1024,
+             variant_cache_size: int = 1024, store: SnapshotStore | None = None,
+             index_fields: Iterable[str] = (), metrics_route: bool = True) -> tornado.web.Application:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix='query')
+    # every request waits for the check of the config directory, so it must not queue behind slow queries
+    reload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='reload')
+    # workers that watch the Kubernetes API share generations through the resourceVersions, not a snapshot file
+    if store is None and snapshot_dir is not None:
+        store = SharedSnapshotStore(config_values, snapshot_dir, reload_interval, reload_executor)
+    elif store is None:
+        store = SnapshotStore(config_values, reload_interval, reload_executor)
+    caches = {'query': ResponseCache(query_cache_size), 'path': ResponseCache(path_cache_size),
+              'variant': ResponseCache(variant_cache_size)}
+    handlers = [
+        (rf"/config(?:/(?P<key>{KEY_PATTERN})(?P<path>(?:/[^/]+)+)?)?/?", KeyValueHandler),
+        (r"/watch/?", WatchHandler),
+    ]
+    if metrics_route:
+        handlers.append((r"/metrics", MetricsHandler))
+    return ConfigServerApplication(
+        handlers=handlers,
         # settings:
         config_values=config_values,
+        config_store=store,
+        query_cache=caches['query'],
+        path_cache=caches['path'],
+        variant_cache=caches['variant'],
+        metrics=ServerMetrics(store, caches),
+        executor=executor,
+        query_timeout=query_timeout,
+        query_max_bytes=query_max_bytes,
+        change_feed=ChangeFeed(store, poll_interval=max(reload_interval, 0.1)),
+        field_indexes=FieldIndexes(index_fields, executor),
     )
 
 
+def make_metrics_app(metrics: ServerMetrics) -> tornado.web.Application:
+    """Application that only serves the metrics of one worker process."""
+    return tornado.web.Application([(r"/metrics", MetricsHandler)], metrics=metrics)
+
+
 def init_logs():
     root = logging.getLogger()
     handler = logging.StreamHandler(sys.stdout)
@@ -82,24 +1559,64 @@ def init_logs():
     logging.getLogger("tornado.general").setLevel(logging.INFO)
 
 
-async def start(config_values: Path, port: int):
+async def start(config_values: Path, port: int, reuse_port: bool = False, config_map: str | None = None,
+                namespace: str | None = None, api_url: str | None = None, metrics_port: int | None = None,
+                **app_options):
     init_logs()
-    log.info(f"Starting server - directory: {config_values}")
-    app = make_app(config_values)
+    if config_map is not None:
+        log.info(f"Starting server - config map: {namespace}/{config_map}")
+        app_options['store'] = KubernetesSnapshotStore(config_map.split(','), namespace, api_url,
+                                                       *_service_account_files())
+    else:
+        log.info(f"Starting server - directory: {config_values}")
+    app = make_app(config_values, metrics_route=metrics_port is None, **app_options)
+    await app.settings['config_store'].ready()
     log.info(f"Serving on port {port}")
-    app.listen(port)
+    app.listen(port, reuse_port=reuse_port)
+    if metrics_port is not None:
+        log.info(f"Serving metrics on port {metrics_port}")
+        make_metrics_app(app.settings['metrics']).listen(metrics_port)
     shutdown_event = asyncio.Event()
     await shutdown_event.wait()
 
 
+def _service_account_files() -> tuple[Path | None, Path | None]:
+    token_file, ca_file = SERVICE_ACCOUNT_DIR / 'token', SERVICE_ACCOUNT_DIR / 'ca.crt'
+    return token_file if token_file.exists() else None, ca_file if ca_file.exists() else None
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
     config_values = Path(args.config_dir)
-    assert config_values.exists()
     port = args.port
 
-    asyncio.run(start(config_values, port))
+    source = {}
+    if args.source == 'kubernetes':
+        if args.config_map is None or args.api_url is None:
+            parser.error("--source kubernetes requires --config-map and --api-url (or running inside a cluster)")
+        source = dict(config_map=args.config_map, namespace=args.namespace, api_url=args.api_url)
+    else:
+        assert config_values.exists()
+
+    workers = dict(metrics_port=args.metrics_port)
+    if args.workers > 1:
+        # every worker binds its own socket with SO_REUSEPORT so the kernel balances connections between them,
+        # the config is shared through the snapshot file
+        worker = tornado.process.fork_processes(args.workers)
+        # a scrape of the shared port would reach a random worker, so each one serves its metrics on its own port
+        metrics_port = args.metrics_port if args.metrics_port is not None else port + 1
+        workers = dict(reuse_port=True, snapshot_dir=Path(args.snapshot_dir), metrics_port=metrics_port + worker)
+
+    asyncio.run(start(config_values, port, **workers, **source,
+                      reload_interval=args.reload_interval,
+                      query_cache_size=args.query_cache_size,
+                      path_cache_size=args.path_cache_size,
+                      variant_cache_size=args.variant_cache_size,
+                      query_workers=args.query_workers,
+                      query_timeout=args.query_timeout,
+                      query_max_bytes=args.query_max_bytes,
+                      index_fields=[field for field in args.index_fields.split(',') if field]))
 
 
 if __name__ == '__main__':
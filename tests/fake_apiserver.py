@@ -0,0 +1,189 @@
+"""Minimal in-process Kubernetes API server for tests.
+
+Stores namespaced objects of any resource in memory and implements the parts of the API that the config server and the
+operator use: get, list (with a ``metadata.name`` field selector), watch (with resourceVersion resume, bookmarks and
+``410 Gone`` for compacted versions), create, replace, JSON merge patch (with resourceVersion preconditions) and
+delete. Every request can be delayed by ``latency`` seconds to simulate a remote API server.
+"""
+import asyncio
+import copy
+import json
+import uuid
+from collections import deque
+
+import tornado.iostream
+import tornado.locks
+import tornado.web
+
+RESOURCE_PATTERN = (r"/(?P<prefix>api/v1|apis/[^/]+/[^/]+)/namespaces/(?P<namespace>[^/]+)/(?P<plural>[^/]+)"
+                    r"(?:/(?P<name>[^/]+))?/?")
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386)."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+class FakeCluster:
+    """Objects and their change history, shared by all requests of a :class:`FakeApiServer`."""
+
+    def __init__(self, history: int = 1000, latency: float = 0.0):
+        self.objects: dict[tuple[str, str, str], dict[str, dict]] = {}
+        self.events: deque[tuple[int, tuple[str, str, str], str, dict]] = deque(maxlen=history)
+        self.resource_version = 0
+        self.latency = latency
+        self.requests: dict[str, int] = {}
+        self.changed = tornado.locks.Condition()
+
+    def collection(self, prefix: str, namespace: str, plural: str) -> dict[str, dict]:
+        return self.objects.setdefault((prefix, namespace, plural), {})
+
+    def record(self, collection: tuple[str, str, str], event_type: str, obj: dict):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.events.append((self.resource_version, collection, event_type, copy.deepcopy(obj)))
+        self.changed.notify_all()
+
+    def put(self, prefix: str, namespace: str, plural: str, obj: dict) -> dict:
+        """Create or replace an object without going through HTTP (for test setup)."""
+        obj = copy.deepcopy(obj)
+        metadata = obj.setdefault("metadata", {})
+        metadata["namespace"] = namespace
+        metadata.setdefault("uid", str(uuid.uuid4()))
+        objects = self.collection(prefix, namespace, plural)
+        event_type = "MODIFIED" if metadata["name"] in objects else "ADDED"
+        objects[metadata["name"]] = obj
+        self.record((prefix, namespace, plural), event_type, obj)
+        return obj
+
+    def remove(self, prefix: str, namespace: str, plural: str, name: str) -> dict | None:
+        obj = self.collection(prefix, namespace, plural).pop(name, None)
+        if obj is not None:
+            self.record((prefix, namespace, plural), "DELETED", obj)
+        return obj
+
+    def oldest_event(self) -> int:
+        return self.events[0][0] if self.events else self.resource_version + 1
+
+
+class ResourceHandler(tornado.web.RequestHandler):
+    cluster: FakeCluster
+
+    def initialize(self, cluster: FakeCluster):
+        self.cluster = cluster
+
+    async def prepare(self):
+        verb = self.request.method.lower()
+        if self.get_query_argument("watch", None) in ("1", "true"):
+            verb = "watch"
+        self.cluster.requests[verb] = self.cluster.requests.get(verb, 0) + 1
+        if self.cluster.latency:
+            await asyncio.sleep(self.cluster.latency)
+
+    def status(self, code: int, reason: str, message: str = ""):
+        self.set_status(code)
+        self.finish({"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": code, "reason": reason,
+                     "message": message})
+
+    def matches(self, obj: dict) -> bool:
+        selector = self.get_query_argument("fieldSelector", None)
+        if not selector:
+            return True
+        for term in selector.split(","):
+            field, _, value = term.partition("=")
+            if field != "metadata.name":
+                raise tornado.web.HTTPError(400, f"unsupported field selector {field}")
+            if obj["metadata"]["name"] != value.lstrip("="):
+                return False
+        return True
+
+    async def get(self, prefix: str, namespace: str, plural: str, name: str = None):
+        objects = self.cluster.collection(prefix, namespace, plural)
+        if name is not None:
+            if name not in objects:
+                return self.status(404, "NotFound", f'{plural} "{name}" not found')
+            return self.finish(objects[name])
+        if self.get_query_argument("watch", None) in ("1", "true"):
+            return await self.watch(prefix, namespace, plural)
+        self.finish({"kind": "List", "apiVersion": "v1",
+                     "metadata": {"resourceVersion": str(self.cluster.resource_version)},
+                     "items": [obj for obj in objects.values() if self.matches(obj)]})
+
+    async def watch(self, prefix: str, namespace: str, plural: str):
+        collection = (prefix, namespace, plural)
+        since = int(self.get_query_argument("resourceVersion", None) or self.cluster.resource_version)
+        bookmarks = self.get_query_argument("allowWatchBookmarks", "false") == "true"
+        deadline = asyncio.get_running_loop().time() + float(self.get_query_argument("timeoutSeconds", "1800"))
+        self.set_header("Content-Type", "application/json")
+        if since < self.cluster.oldest_event() - 1:
+            self.write_event("ERROR", {"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": 410,
+                                       "reason": "Expired", "message": f"too old resource version: {since}"})
+            return self.finish()
+        try:
+            while True:
+                for version, event_collection, event_type, obj in list(self.cluster.events):
+                    if version > since and event_collection == collection and self.matches(obj):
+                        self.write_event(event_type, obj)
+                since = self.cluster.resource_version
+                if bookmarks:
+                    self.write_event("BOOKMARK", {"kind": "ConfigMap", "apiVersion": "v1",
+                                                  "metadata": {"resourceVersion": str(since)}})
+                await self.flush()
+                if not await self.cluster.changed.wait(timeout=deadline):
+                    break
+        except tornado.iostream.StreamClosedError:
+            return
+        self.finish()
+
+    def write_event(self, event_type: str, obj: dict):
+        self.write(json.dumps({"type": event_type, "object": obj}) + "\n")
+
+    def post(self, prefix: str, namespace: str, plural: str, name: str = None):
+        obj = json.loads(self.request.body)
+        objects = self.cluster.collection(prefix, namespace, plural)
+        if obj["metadata"]["name"] in objects:
+            return self.status(409, "AlreadyExists", f'{plural} "{obj["metadata"]["name"]}" already exists')
+        self.set_status(201)
+        self.finish(self.cluster.put(prefix, namespace, plural, obj))
+
+    def put(self, prefix: str, namespace: str, plural: str, name: str = None):
+        obj = json.loads(self.request.body)
+        objects = self.cluster.collection(prefix, namespace, plural)
+        if name not in objects:
+            return self.status(404, "NotFound", f'{plural} "{name}" not found')
+        expected = obj.get("metadata", {}).get("resourceVersion")
+        if expected is not None and expected != objects[name]["metadata"]["resourceVersion"]:
+            return self.status(409, "Conflict", "the object has been modified")
+        self.finish(self.cluster.put(prefix, namespace, plural, obj))
+
+    def patch(self, prefix: str, namespace: str, plural: str, name: str = None):
+        content_type = self.request.headers.get("Content-Type", "").split(";")[0]
+        if content_type not in ("application/merge-patch+json", "application/strategic-merge-patch+json"):
+            return self.status(415, "UnsupportedMediaType", f"unsupported patch type {content_type}")
+        patch = json.loads(self.request.body)
+        objects = self.cluster.collection(prefix, namespace, plural)
+        if name not in objects:
+            return self.status(404, "NotFound", f'{plural} "{name}" not found')
+        expected = patch.get("metadata", {}).get("resourceVersion")
+        if expected is not None and expected != objects[name]["metadata"]["resourceVersion"]:
+            return self.status(409, "Conflict", "the object has been modified")
+        self.finish(self.cluster.put(prefix, namespace, plural, merge_patch(objects[name], patch)))
+
+    def delete(self, prefix: str, namespace: str, plural: str, name: str = None):
+        obj = self.cluster.remove(prefix, namespace, plural, name)
+        if obj is None:
+            return self.status(404, "NotFound", f'{plural} "{name}" not found')
+        self.finish(obj)
+
+
+def make_fake_apiserver(cluster: FakeCluster | None = None) -> tornado.web.Application:
+    cluster = cluster if cluster is not None else FakeCluster()
+    return tornado.web.Application([(RESOURCE_PATTERN, ResourceHandler, dict(cluster=cluster))], cluster=cluster)
@@ -85,4 +85,6 @@ def random_namespace():
 
 @pytest.fixture(scope="session")
 def operator_file():
+    # the operator runs inside the test process, keep it from binding the metrics port on the test host
+    os.environ.setdefault('CONFIG_SERVER_METRICS_PORT', '0')
     return os.path.abspath(os.path.join(os.path.dirname(__file__), '../../opr/operator.py'))
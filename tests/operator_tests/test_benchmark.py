@@ -0,0 +1,13 @@
+import asyncio
+
+from benchmarks.bench_operator import benchmark
+
+
+def test_benchmark_smoke():
+    result = asyncio.run(benchmark(key_value_pairs=20, config_servers=2, shards=2, batch_window=0.01))
+    assert result["key_value_pairs"] == 20
+    scenarios = result["scenarios"]
+    assert scenarios["create_key_value_pairs"]["events"] == 20
+    assert scenarios["noop_update_key_value_pairs"]["api_calls_per_event"] == 0
+    for name, scenario in scenarios.items():
+        assert scenario["convergence_seconds"] > 0, name
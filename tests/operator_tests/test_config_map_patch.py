@@ -0,0 +1,199 @@
+import asyncio
+import base64
+import logging
+
+import kopf
+import pytest
+from kubernetes_asyncio.client import V1ConfigMap, V1ObjectMeta
+from kubernetes_asyncio.client.exceptions import ApiException
+
+from opr import operator
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def content_hashes(mocker):
+    return mocker.patch.object(operator, "content_hashes", operator.ContentHashes())
+
+
+def config_map(resource_version: str) -> V1ConfigMap:
+    return V1ConfigMap(metadata=V1ObjectMeta(name="test-values", resource_version=resource_version),
+                       data={"key": '"old"'})
+
+
+@pytest.mark.asyncio
+async def test_patch_only_touches_key(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch.object(operator, "_get_config_map", return_value=(config_map("1"), api))
+
+    await operator._patch_config_map_data("test", "default", {"key": '"value"'}, logger)
+
+    api.patch_namespaced_config_map.assert_called_once()
+    kwargs = api.patch_namespaced_config_map.call_args.kwargs
+    assert kwargs["body"] == {"metadata": {"resourceVersion": "1"}, "data": {"key": '"value"'}}
+    assert kwargs["_content_type"] == "application/merge-patch+json"
+
+
+@pytest.mark.asyncio
+async def test_patch_retries_on_conflict(mocker):
+    api = mocker.AsyncMock()
+    api.patch_namespaced_config_map.side_effect = [ApiException(status=409), None]
+    mocker.patch.object(operator, "_get_config_map", side_effect=[(config_map("1"), api), (config_map("2"), api)])
+    mocker.patch.object(operator, "PATCH_RETRY_BACKOFF", 0)
+
+    await operator._patch_config_map_data("test", "default", {"key": None}, logger)
+
+    assert api.patch_namespaced_config_map.call_count == 2
+    assert api.patch_namespaced_config_map.call_args.kwargs["body"]["metadata"]["resourceVersion"] == "2"
+
+
+@pytest.mark.asyncio
+async def test_patch_gives_up_after_retries(mocker):
+    api = mocker.AsyncMock()
+    api.patch_namespaced_config_map.side_effect = ApiException(status=409)
+    mocker.patch.object(operator, "_get_config_map", side_effect=lambda *args: (config_map("1"), api))
+    mocker.patch.object(operator, "PATCH_RETRY_BACKOFF", 0)
+
+    with pytest.raises(kopf.TemporaryError):
+        await operator._patch_config_map_data("test", "default", {"key": None}, logger)
+    assert api.patch_namespaced_config_map.call_count == operator.PATCH_RETRIES
+
+
+@pytest.mark.asyncio
+async def test_batcher_coalesces_writes(mocker):
+    patch = mocker.patch.object(operator, "_patch_config_map_data", new_callable=mocker.AsyncMock)
+    batcher = operator.ConfigMapWriteBatcher(window=0.5, size=3)
+
+    await asyncio.gather(*(batcher.submit("test", "default", f"key-{i}", str(i), logger) for i in range(3)))
+
+    patch.assert_awaited_once_with("test", "default", {"key-0": "0", "key-1": "1", "key-2": "2"}, logger,
+                                   compiled=False)
+
+
+@pytest.mark.asyncio
+async def test_batcher_reports_errors_to_all_handlers(mocker):
+    mocker.patch.object(operator, "_patch_config_map_data", new_callable=mocker.AsyncMock,
+                        side_effect=ApiException(status=500))
+    batcher = operator.ConfigMapWriteBatcher(window=0.5, size=2)
+
+    errors = await asyncio.gather(*(batcher.submit("test", "default", f"key-{i}", None, logger) for i in range(2)),
+                                  return_exceptions=True)
+
+    assert sorted(type(e).__name__ for e in errors) == ["ApiException", "TemporaryError"]
+
+
+@pytest.mark.asyncio
+async def test_patch_skips_unchanged_keys(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch.object(operator, "_get_config_map", return_value=(config_map("1"), api))
+
+    await operator._patch_config_map_data("test", "default", {"key": '"old"', "other": None}, logger)
+
+    api.patch_namespaced_config_map.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_patch_prunes_unknown_keys(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch.object(operator, "_get_config_map", return_value=(config_map("1"), api))
+
+    await operator._patch_config_map_data("test", "default", {"new": "1"}, logger, prune=True)
+
+    assert api.patch_namespaced_config_map.call_args.kwargs["body"]["data"] == {"new": "1", "key": None}
+
+
+@pytest.mark.asyncio
+async def test_batcher_skips_known_values(mocker, content_hashes):
+    patch = mocker.patch.object(operator, "_patch_config_map_data", new_callable=mocker.AsyncMock)
+    content_hashes.update(("default", "test"), {"key": '"old"'})
+    batcher = operator.ConfigMapWriteBatcher(window=0.5, size=3)
+
+    await batcher.submit("test", "default", "key", '"old"', logger)
+    await batcher.submit("test", "default", "missing", None, logger)
+
+    patch.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_patch_writes_compiled_snapshot(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch.object(operator, "_get_config_map", return_value=(config_map("1"), api))
+
+    await operator._patch_config_map_data("test", "default", {"new": "1"}, logger, compiled=True)
+
+    binary_data = api.patch_namespaced_config_map.call_args.kwargs["body"]["binaryData"]
+    assert list(binary_data) == [".config-snapshot-test"]
+    assert base64.b64decode(binary_data[".config-snapshot-test"]) == \
+        operator.compile_snapshot({"key": '"old"', "new": "1"})
+
+
+@pytest.mark.asyncio
+async def test_patch_removes_stale_compiled_snapshot(mocker):
+    api = mocker.AsyncMock()
+    current = config_map("1")
+    current.binary_data = {".config-snapshot-test": "Q1NOUA=="}
+    mocker.patch.object(operator, "_get_config_map", return_value=(current, api))
+
+    await operator._patch_config_map_data("test", "default", {"key": '"old"'}, logger)
+
+    body = api.patch_namespaced_config_map.call_args.kwargs["body"]
+    assert body["data"] == {}
+    assert body["binaryData"] == {".config-snapshot-test": None}
+
+
+@pytest.mark.asyncio
+async def test_batcher_writes_reverted_values(mocker, content_hashes):
+    patch = mocker.patch.object(operator, "_patch_config_map_data", new_callable=mocker.AsyncMock)
+    content_hashes.update(("default", "test"), {"key": '"0"'})
+    batcher = operator.ConfigMapWriteBatcher(window=0.1, size=3)
+
+    await asyncio.gather(batcher.submit("test", "default", "key", '"1"', logger),
+                         batcher.submit("test", "default", "key", '"0"', logger))
+
+    patch.assert_awaited_once_with("test", "default", {"key": '"0"'}, logger, compiled=False)
+
+
+@pytest.mark.asyncio
+async def test_batcher_writes_reverted_values_during_flush(mocker, content_hashes):
+    written = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_patch(config_map_name, namespace, data, logger, compiled=False):
+        written.set()
+        await release.wait()
+
+    patch = mocker.patch.object(operator, "_patch_config_map_data", side_effect=slow_patch)
+    content_hashes.update(("default", "test"), {"key": '"0"'})
+    batcher = operator.ConfigMapWriteBatcher(window=0.0, size=1)
+
+    first = asyncio.create_task(batcher.submit("test", "default", "key", '"1"', logger))
+    await written.wait()
+    second = asyncio.create_task(batcher.submit("test", "default", "key", '"0"', logger))
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(first, second)
+
+    assert [call.args[2] for call in patch.await_args_list] == [{"key": '"1"'}, {"key": '"0"'}]
+
+
+@pytest.mark.asyncio
+async def test_batcher_recovers_from_cancelled_leader(mocker):
+    patch = mocker.patch.object(operator, "_patch_config_map_data", new_callable=mocker.AsyncMock)
+    batcher = operator.ConfigMapWriteBatcher(window=10, size=10)
+
+    leader = asyncio.create_task(batcher.submit("test", "default", "a", "1", logger))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(batcher.submit("test", "default", "b", "2", logger))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    with pytest.raises(kopf.TemporaryError):
+        await asyncio.wait_for(follower, 1)
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    patch.assert_not_awaited()
+
+    batcher.window = 0
+    await asyncio.wait_for(batcher.submit("test", "default", "a", "1", logger), 1)
+    patch.assert_awaited_once_with("test", "default", {"a": "1"}, logger, compiled=False)
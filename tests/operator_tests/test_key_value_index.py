@@ -0,0 +1,109 @@
+import logging
+
+import pytest
+
+from opr import operator
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_index_groups_by_config_server():
+    entry = await operator.key_value_index(namespace="default", meta={},
+                                           spec={"config": "test", "key": "k", "value": [1]})
+
+    assert entry == {("default", "test"): ("k", "[1]")}
+
+
+@pytest.mark.asyncio
+async def test_index_skips_deleted_pairs():
+    entry = await operator.key_value_index(namespace="default", meta={"deletionTimestamp": "2024-01-01T00:00:00Z"},
+                                           spec={"config": "test", "key": "k", "value": [1]})
+
+    assert entry is None
+
+
+@pytest.mark.asyncio
+async def test_create_uses_indexed_values(mocker):
+    mocker.patch.object(operator, "get_api_client")
+    core_api = mocker.patch.object(operator, "CoreV1Api").return_value
+    core_api.create_namespaced_config_map = mocker.AsyncMock()
+    mocker.patch.object(operator, "_apply_server")
+    index = {("default", "test"): [("a", '"1"'), ("b", "2")], ("default", "other"): [("c", "3")]}
+    spec = {"image": "config-server", "imagePullPolicy": "Never", "containerPort": 8080, "configMountPath": "/config"}
+
+    await operator.create_fn(meta={"name": "test", "namespace": "default"}, spec=spec, logger=logger,
+                             key_value_index=index)
+
+    config_map = core_api.create_namespaced_config_map.call_args.kwargs["body"]
+    assert config_map.data == {"a": '"1"', "b": "2"}
+
+
+@pytest.mark.asyncio
+async def test_create_shards_values(mocker):
+    mocker.patch.object(operator, "get_api_client")
+    core_api = mocker.patch.object(operator, "CoreV1Api").return_value
+    core_api.create_namespaced_config_map = mocker.AsyncMock()
+    mocker.patch.object(operator, "_apply_server")
+    data = {f"key-{i}": str(i) for i in range(20)}
+    index = {("default", "test"): list(data.items())}
+    spec = {"image": "config-server", "imagePullPolicy": "Never", "containerPort": 8080, "configMountPath": "/config",
+            "shards": 3}
+
+    await operator.create_fn(meta={"name": "test", "namespace": "default"}, spec=spec, logger=logger,
+                             key_value_index=index)
+
+    config_maps = {call.kwargs["body"].metadata["name"]: call.kwargs["body"].data
+                   for call in core_api.create_namespaced_config_map.call_args_list}
+    assert sorted(config_maps) == ["test-values", "test-values-1", "test-values-2"]
+    assert {key: value for shard in config_maps.values() for key, value in shard.items()} == data
+    for shard, config_map_name in enumerate(operator.shard_config_maps("test", spec)):
+        assert all(operator.shard_of(key, 3) == shard for key in config_maps[config_map_name])
+
+
+@pytest.mark.asyncio
+async def test_update_moves_keys_to_fewer_shards(mocker):
+    mocker.patch.object(operator, "get_api_client")
+    core_api = mocker.patch.object(operator, "CoreV1Api").return_value
+    core_api.delete_namespaced_config_map = mocker.AsyncMock()
+    write_shards = mocker.patch.object(operator, "_write_shards")
+    mocker.patch.object(operator, "_apply_server")
+    index = {("default", "test"): [("a", "1")]}
+    spec = {"image": "config-server", "imagePullPolicy": "Never", "containerPort": 8080, "configMountPath": "/config"}
+
+    # kopf narrows old to the old spec for handlers of field='spec'
+    await operator.update_fn(meta={"name": "test", "namespace": "default"}, spec={**spec, "shards": 1},
+                             old={**spec, "shards": 3}, logger=logger, key_value_index=index)
+
+    write_shards.assert_awaited_once_with("test", "default", {**spec, "shards": 1}, {"a": "1"}, logger)
+    deleted = sorted(call.args[0] for call in core_api.delete_namespaced_config_map.call_args_list)
+    assert deleted == ["test-values-1", "test-values-2"]
+
+
+@pytest.mark.asyncio
+async def test_update_rewrites_shards_when_compiled_snapshots_are_disabled(mocker):
+    mocker.patch.object(operator, "get_api_client")
+    core_api = mocker.patch.object(operator, "CoreV1Api").return_value
+    core_api.delete_namespaced_config_map = mocker.AsyncMock()
+    write_shards = mocker.patch.object(operator, "_write_shards")
+    mocker.patch.object(operator, "_apply_server")
+    index = {("default", "test"): [("a", "1")]}
+    spec = {"image": "config-server", "imagePullPolicy": "Never", "containerPort": 8080, "configMountPath": "/config"}
+
+    await operator.update_fn(meta={"name": "test", "namespace": "default"}, spec={**spec, "compiledSnapshot": False},
+                             old={**spec, "compiledSnapshot": True}, logger=logger, key_value_index=index)
+
+    # the shards are patched without compiled, which removes the stale snapshots
+    write_shards.assert_awaited_once_with("test", "default", {**spec, "compiledSnapshot": False}, {"a": "1"}, logger)
+    core_api.delete_namespaced_config_map.assert_not_called()
+
+
+def test_keys_are_written_to_their_shard():
+    index = {("default", "test"): [{"shards": 4, "compiledSnapshot": True}]}
+    spec = {"config": "test", "key": "some-key"}
+
+    config_map_name, compiled = operator._key_config_map("default", spec, index)
+
+    assert config_map_name == operator.shard_config_map("test", operator.shard_of("some-key", 4))
+    assert compiled
+    assert operator._key_config_map("default", {"config": "unknown", "key": "k"}, index) == ("unknown-values", False)
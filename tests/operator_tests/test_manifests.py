@@ -0,0 +1,83 @@
+import kubernetes_asyncio
+import pytest
+
+from opr import operator
+
+SPEC = {"image": "config-server", "imagePullPolicy": "Never", "containerPort": 8080, "configMountPath": "/config"}
+
+
+def test_deployment_uses_replicas_and_resources():
+    resources = {"requests": {"cpu": "100m"}, "limits": {"memory": "128Mi"}}
+    manifest = operator.deployment_manifest("test", "default", {**SPEC, "replicas": 3, "resources": resources})
+
+    assert manifest["spec"]["replicas"] == 3
+    assert manifest["spec"]["template"]["spec"]["containers"][0]["resources"] == resources
+
+
+def test_autoscaling_owns_replicas():
+    spec = {**SPEC, "replicas": 3, "autoscaling": {"enabled": True, "minReplicas": 2, "maxReplicas": 5}}
+
+    assert "replicas" not in operator.deployment_manifest("test", "default", spec)["spec"]
+    autoscaler = operator.autoscaler_manifest("test", "default", spec)
+    assert autoscaler["spec"]["minReplicas"] == 2
+    assert autoscaler["spec"]["maxReplicas"] == 5
+    assert autoscaler["spec"]["scaleTargetRef"]["name"] == "test"
+
+
+def test_disruption_budget_only_for_multiple_replicas():
+    assert operator.autoscaler_manifest("test", "default", SPEC) is None
+    assert operator.disruption_budget_manifest("test", "default", SPEC) is None
+    budget = operator.disruption_budget_manifest("test", "default", {**SPEC, "replicas": 2})
+    assert budget["spec"]["maxUnavailable"] == 1
+    assert budget["spec"]["selector"] == {"matchLabels": {"app": "test"}}
+
+
+@pytest.mark.asyncio
+async def test_apply_creates_missing_objects(mocker):
+    create, patch, delete = mocker.AsyncMock(), mocker.AsyncMock(), mocker.AsyncMock()
+    patch.side_effect = kubernetes_asyncio.client.exceptions.ApiException(status=404)
+    manifest = operator.service_manifest("test", "default", SPEC)
+
+    await operator._apply(create, patch, delete, "test", "default", manifest)
+
+    assert patch.call_args.kwargs["_content_type"] == "application/merge-patch+json"
+    create.assert_awaited_once_with("default", body=manifest)
+
+
+@pytest.mark.asyncio
+async def test_apply_removes_disabled_objects(mocker):
+    create, patch, delete = mocker.AsyncMock(), mocker.AsyncMock(), mocker.AsyncMock()
+    delete.side_effect = kubernetes_asyncio.client.exceptions.ApiException(status=404)
+
+    await operator._apply(create, patch, delete, "test", "default", None)
+
+    delete.assert_awaited_once_with("test", "default")
+    create.assert_not_awaited()
+    patch.assert_not_awaited()
+
+
+def test_kubernetes_source_uses_own_service_account():
+    spec = {**SPEC, "source": "kubernetes"}
+    pod_spec = operator.deployment_manifest("test", "default", spec)["spec"]["template"]["spec"]
+    env = {var["name"]: var.get("value") for var in pod_spec["containers"][0]["env"]}
+
+    assert pod_spec["serviceAccountName"] == "test"
+    assert env["CONFIG_SERVER_SOURCE"] == "kubernetes"
+    assert env["CONFIG_SERVER_CONFIG_MAP"] == "test-values"
+    service_account, role, role_binding = operator.service_account_manifests("test", "default", spec)
+    assert role["rules"][0]["resourceNames"] == ["test-values"]
+    assert role_binding["subjects"][0]["name"] == service_account["metadata"]["name"]
+
+
+def test_volume_source_has_no_service_account():
+    pod_spec = operator.deployment_manifest("test", "default", SPEC)["spec"]["template"]["spec"]
+
+    assert pod_spec["serviceAccountName"] is None
+    assert operator.service_account_manifests("test", "default", SPEC) == (None, None, None)
+
+
+def test_shards_are_mounted_into_one_directory():
+    pod_spec = operator.deployment_manifest("test", "default", {**SPEC, "shards": 2})["spec"]["template"]["spec"]
+
+    sources = pod_spec["volumes"][0]["projected"]["sources"]
+    assert [source["configMap"]["name"] for source in sources] == ["test-values", "test-values-1"]
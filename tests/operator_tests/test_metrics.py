@@ -0,0 +1,106 @@
+import importlib.util
+import logging
+import urllib.request
+
+import kubernetes_asyncio
+import pytest
+from kubernetes_asyncio.client import CoreV1Api, V1ConfigMap, V1ObjectMeta
+from kubernetes_asyncio.client.exceptions import ApiException
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from opr import operator
+from tests.fake_apiserver import make_fake_apiserver
+
+logger = logging.getLogger(__name__)
+
+
+def sample(name: str, **labels) -> float:
+    return operator.REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_handler_duration_and_errors():
+    @operator.instrumented
+    async def failing_fn(**kwargs):
+        raise RuntimeError("failed")
+
+    count = sample("config_operator_handler_duration_seconds_count", handler="failing_fn")
+
+    with pytest.raises(RuntimeError):
+        await failing_fn(meta={}, spec={})
+
+    assert sample("config_operator_handler_duration_seconds_count", handler="failing_fn") == count + 1
+    assert sample("config_operator_handler_errors_total", handler="failing_fn") == 1
+
+
+@pytest.mark.asyncio
+async def test_api_requests_per_verb():
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(make_fake_apiserver())
+    server.add_sockets(sockets)
+    configuration = kubernetes_asyncio.client.Configuration(host=f"http://127.0.0.1:{sockets[0].getsockname()[1]}")
+    created = sample("config_operator_api_requests_total", verb="create", code="201")
+    not_found = sample("config_operator_api_requests_total", verb="get", code="404")
+    try:
+        async with operator.InstrumentedApiClient(configuration=configuration) as client:
+            api = CoreV1Api(api_client=client)
+            await api.create_namespaced_config_map("default", body=V1ConfigMap(metadata=V1ObjectMeta(name="test")))
+            with pytest.raises(ApiException):
+                await api.read_namespaced_config_map("missing", "default")
+    finally:
+        server.stop()
+
+    assert sample("config_operator_api_requests_total", verb="create", code="201") == created + 1
+    assert sample("config_operator_api_requests_total", verb="get", code="404") == not_found + 1
+    assert sample("config_operator_api_request_duration_seconds_count", verb="get") >= 1
+
+
+@pytest.mark.asyncio
+async def test_patch_metrics(mocker):
+    mocker.patch.object(operator, "content_hashes", operator.ContentHashes())
+    api = mocker.AsyncMock()
+    api.patch_namespaced_config_map.side_effect = [ApiException(status=409), None]
+    config_map = V1ConfigMap(metadata=V1ObjectMeta(name="metrics-values", resource_version="1"), data={"a": "1"})
+    mocker.patch.object(operator, "_get_config_map", return_value=(config_map, api))
+    mocker.patch.object(operator, "PATCH_RETRY_BACKOFF", 0)
+    conflicts = sample("config_operator_config_map_conflicts_total")
+    patches = sample("config_operator_config_map_patch_keys_count")
+
+    await operator._patch_config_map_data("metrics-values", "default", {"b": "22"}, logger)
+
+    assert sample("config_operator_config_map_conflicts_total") == conflicts + 1
+    assert sample("config_operator_config_map_patch_keys_count") == patches + 2
+    assert sample("config_operator_config_map_bytes", namespace="default", config_map="metrics-values") == 5
+
+
+def test_operator_file_can_be_loaded_twice():
+    # kopf loads the operator file as a new module for every run
+    modules = []
+    for name in ("operator_run_1", "operator_run_2"):
+        spec = importlib.util.spec_from_file_location(name, operator.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules.append(module)
+
+    assert modules[0].REGISTRY is not modules[1].REGISTRY
+
+
+@pytest.mark.asyncio
+async def test_metrics_server_per_run(mocker):
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    for sock in sockets:
+        sock.close()
+    mocker.patch.object(operator, "METRICS_PORT", port)
+    mocker.patch.object(operator, "load_kubernetes_config", return_value=kubernetes_asyncio.client.Configuration())
+    settings = mocker.Mock()
+
+    # a second run in the same process binds the port again after the first one was cleaned up
+    for _ in range(2):
+        await operator.configure_fn(settings=settings, logger=logger)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                assert b"config_operator_api_requests_total" in response.read()
+        finally:
+            await operator.cleanup_fn()
@@ -0,0 +1,12 @@
+import asyncio
+
+from benchmarks.bench_server import benchmark
+
+
+def test_benchmark_smoke():
+    result = asyncio.run(benchmark(keys=5, value_size=200, requests=10, concurrency=2))
+    assert result["keys"] == 5
+    for name, scenario in result["scenarios"].items():
+        assert scenario["errors"] == 0, name
+        assert scenario["requests"] > 0
+        assert scenario["p99_ms"] >= scenario["p50_ms"]
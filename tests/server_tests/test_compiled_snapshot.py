@@ -0,0 +1,51 @@
+import json
+
+from opr import operator
+from srv.server import CompressedConfigEntry, load_snapshot, map_snapshot
+
+
+def values() -> dict[str, str]:
+    return {"small": json.dumps({"foo": "</bar>"}),
+            "large": json.dumps({"items": [{"id": i, "name": "ü" * 10} for i in range(50)]}),
+            "broken": "not json"}
+
+
+def test_compiled_snapshot_matches_parsed_values(tmp_path):
+    for key, text in values().items():
+        (tmp_path / key).write_text(text)
+    parsed = load_snapshot(tmp_path)
+
+    compiled = map_snapshot(operator.compile_snapshot(values()))
+
+    assert compiled.version == parsed.version
+    assert isinstance(compiled.entries["large"], CompressedConfigEntry)
+    for key in ("small", "large"):
+        assert compiled.entries[key].body == parsed.entries[key].body
+        assert compiled.entries[key].etag == parsed.entries[key].etag
+        assert compiled.entries[key].value == parsed.entries[key].value
+    assert compiled.entries["broken"].error == parsed.entries["broken"].error
+
+
+def test_load_maps_compiled_snapshots(tmp_path):
+    data = values()
+    for key, text in data.items():
+        (tmp_path / key).write_text(text)
+    (tmp_path / "plain").write_text("1")
+    (tmp_path / ".config-snapshot-test-values").write_bytes(operator.compile_snapshot(data))
+
+    snapshot = load_snapshot(tmp_path, generation=3)
+
+    assert snapshot.generation == 3
+    assert sorted(snapshot.entries) == ["broken", "large", "plain", "small"]
+    assert isinstance(snapshot.entries["large"], CompressedConfigEntry)
+    assert snapshot.entries["large"]._body is None
+    assert snapshot.entries["plain"].value == 1
+
+
+def test_load_ignores_invalid_compiled_snapshots(tmp_path):
+    (tmp_path / "a").write_text("1")
+    (tmp_path / ".config-snapshot-test-values").write_bytes(b"garbage")
+
+    snapshot = load_snapshot(tmp_path)
+
+    assert sorted(snapshot.entries) == ["a"]
@@ -0,0 +1,81 @@
+import gzip
+import json
+import pathlib
+
+import brotli
+import cbor2
+import msgpack
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from srv.server import make_app, parse_accept, negotiate_media_type
+
+large_value = {"items": [{"id": i, "name": f"item-{i}"} for i in range(200)]}
+
+
+@pytest.fixture(scope='function')
+def tmp_path_cls(request, tmp_path):
+    request.cls.config_values = tmp_path
+
+
+def test_parse_accept():
+    assert parse_accept("application/json;q=0.5, application/msgpack") == ["application/msgpack", "application/json"]
+    assert parse_accept("gzip;q=0, br") == ["br"]
+    assert negotiate_media_type(None) == "application/json"
+    assert negotiate_media_type("*/*") == "application/json"
+    assert negotiate_media_type("text/html") == "application/json"
+    assert negotiate_media_type("application/cbor, application/json;q=0.9") == "application/cbor"
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestContentNegotiation(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "large").write_text(json.dumps(large_value))
+        (self.config_values / "small").write_text(json.dumps({"foo": "bar"}))
+        return make_app(self.config_values)
+
+    def fetch_raw(self, path: str, **headers):
+        return self.fetch(path, headers=headers, decompress_response=False)
+
+    def test_msgpack(self):
+        response = self.fetch_raw('/config/small', Accept="application/msgpack")
+        self.assertEqual(response.headers["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.body), {"foo": "bar"})
+        self.assertIn("Accept", response.headers["Vary"])
+
+        response = self.fetch_raw('/config/small', Accept="application/msgpack",
+                                  **{"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(response.code, 304)
+
+    def test_cbor_query(self):
+        response = self.fetch('/config', method='POST', body=json.dumps({"query": "foo"}),
+                              headers={"Accept": "application/cbor"})
+        self.assertEqual(response.headers["Content-Type"], "application/cbor")
+        self.assertEqual(cbor2.loads(response.body), {"small": "bar"})
+
+    def test_compression(self):
+        identity = self.fetch_raw('/config/large')
+        self.assertNotIn("Content-Encoding", identity.headers)
+
+        response = self.fetch_raw('/config/large', **{"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.body)), large_value)
+        self.assertNotEqual(response.headers["Etag"], identity.headers["Etag"])
+
+        response = self.fetch_raw('/config/large', **{"Accept-Encoding": "gzip;q=0.5, br"})
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(json.loads(brotli.decompress(response.body)), large_value)
+
+        # small bodies are sent uncompressed
+        response = self.fetch_raw('/config/small', **{"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_variants_are_cached(self):
+        entry = self._app.settings['config_store'].snapshot.entries["large"]
+        self.fetch_raw('/config/large', Accept="application/msgpack", **{"Accept-Encoding": "br"})
+        self.assertIn(("application/msgpack", "br"), entry.variants)
+        cached = entry.variants[("application/msgpack", "br")]
+        self.fetch_raw('/config/large', Accept="application/msgpack", **{"Accept-Encoding": "br"})
+        self.assertIs(entry.variants[("application/msgpack", "br")], cached)
@@ -1,10 +1,15 @@
 import json
 import pathlib
+import threading
+import time
+import unittest.mock
 
 import pytest
 from tornado.testing import AsyncHTTPTestCase
 
-from srv.server import make_app
+import jmespath
+
+from srv.server import KeyValueHandler, make_app, query_conditions, query_matches
 
 
 @pytest.fixture(scope='function')
@@ -46,3 +51,422 @@ class TestKeyHandler(AsyncHTTPTestCase):
         self.assertEqual(response.code, 400)
 
         test_file.unlink()
+
+    def test_key_updated(self):
+        test_file = self.config_values / "test"
+        test_file.write_text(json.dumps({"foo": "bar"}))
+        response = self.fetch('/config/test')
+        self.assertEqual(json.loads(response.body), {"foo": "bar"})
+
+        test_file.write_text(json.dumps({"foo": "baz", "new": 1}))
+        response = self.fetch('/config/test')
+        self.assertEqual(json.loads(response.body), {"foo": "baz", "new": 1})
+
+
+def write_kubelet_revision(directory: pathlib.Path, revision: str, values: dict):
+    """Mimic the way kubelet mounts config maps: a timestamped directory behind an atomically swapped '..data' link."""
+    revision_dir = directory / f"..{revision}"
+    revision_dir.mkdir()
+    for key, value in values.items():
+        (revision_dir / key).write_text(json.dumps(value))
+        link = directory / key
+        if not link.is_symlink():
+            link.symlink_to(pathlib.Path("..data") / key)
+    tmp_link = directory / "..data_tmp"
+    tmp_link.symlink_to(revision_dir.name)
+    tmp_link.rename(directory / "..data")
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestKubeletSnapshot(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        write_kubelet_revision(self.config_values, "rev1", {"a": {"v": 1}, "b": [1, 2]})
+        return make_app(self.config_values)
+
+    def test_snapshot_swap(self):
+        response = self.fetch('/config/a')
+        self.assertEqual(json.loads(response.body), {"v": 1})
+        response = self.fetch('/config/b')
+        self.assertEqual(json.loads(response.body), [1, 2])
+
+        store = self._app.settings['config_store']
+        generation = store.snapshot.generation
+        write_kubelet_revision(self.config_values, "rev2", {"a": {"v": 2}, "b": [3]})
+
+        response = self.fetch('/config/a')
+        self.assertEqual(json.loads(response.body), {"v": 2})
+        self.assertEqual(store.snapshot.generation, generation + 1)
+
+    def test_unchanged_directory_keeps_snapshot(self):
+        store = self._app.settings['config_store']
+        snapshot = store.snapshot
+        self.fetch('/config/a')
+        self.assertIs(store.snapshot, snapshot)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestSaturatedQueryPool(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        return make_app(self.config_values, query_workers=2)
+
+    def test_get_does_not_wait_for_queries(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        executor = self._app.settings['executor']
+        for _ in range(4):
+            executor.submit(release.wait, 10)
+        (self.config_values / "a").write_text(json.dumps({"team": "y"}))
+
+        started = time.monotonic()
+        response = self.fetch('/config/a')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(json.loads(response.body), {"team": "y"})
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestQuery(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x", "size": 1}))
+        (self.config_values / "b").write_text(json.dumps({"team": "y", "size": 2}))
+        (self.config_values / "broken").write_text("not json")
+        return make_app(self.config_values)
+
+    def query(self, expression: str):
+        return self.fetch('/config', method='POST', body=json.dumps({"query": expression}))
+
+    def test_query(self):
+        response = self.query("team == 'x'")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"a": True})
+
+        response = self.fetch('/config', method='POST', body=json.dumps({}))
+        self.assertEqual(json.loads(response.body), {"a": ["x", 1], "b": ["y", 2]})
+
+    def test_invalid_query(self):
+        response = self.query("team ==")
+        self.assertEqual(response.code, 400)
+
+    def test_query_cache_invalidated_on_change(self):
+        response = self.query("size")
+        self.assertEqual(json.loads(response.body), {"a": 1, "b": 2})
+        generation = self._app.settings['config_store'].snapshot.generation
+        self.assertIsNotNone(self._app.settings['query_cache'].get(("size", generation, None, None)))
+
+        (self.config_values / "c").write_text(json.dumps({"size": 3}))
+        response = self.query("size")
+        self.assertEqual(json.loads(response.body), {"a": 1, "b": 2, "c": 3})
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestPaginatedQuery(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        for i in range(10):
+            (self.config_values / f"key-{i}").write_text(json.dumps({"size": i}))
+        (self.config_values / "broken").write_text("not json")
+        return make_app(self.config_values)
+
+    def setUp(self):
+        # several chunks per stream
+        patcher = unittest.mock.patch.object(KeyValueHandler, "stream_chunk_size", 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def query(self, headers: dict | None = None, **body):
+        return self.fetch('/config', method='POST', body=json.dumps({"query": "size", **body}), headers=headers)
+
+    def stream(self, **body) -> list[dict]:
+        response = self.query(headers={"Accept": "application/x-ndjson"}, **body)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in response.body.decode().splitlines()]
+
+    def test_pages(self):
+        values, after = {}, None
+        for _ in range(5):
+            page = json.loads(self.query(limit=4, after=after).body)
+            self.assertLessEqual(len(page["values"]), 4)
+            values.update(page["values"])
+            after = page["next"]
+            if after is None:
+                break
+        self.assertIsNone(after)
+        # key-0 has size 0, which is not a match
+        self.assertEqual(values, {f"key-{i}": i for i in range(1, 10)})
+
+    def keys_scanned(self) -> float:
+        metric = self._app.settings['metrics'].query_keys_scanned.collect()[0]
+        return next(sample.value for sample in metric.samples if sample.name.endswith('_sum'))
+
+    def test_pages_record_scanned_keys(self):
+        # broken, key-0 and key-1 are scanned for the first match, key-2 for the second
+        page = json.loads(self.query(limit=2).body)
+        self.assertEqual(page["next"], "key-2")
+        self.assertEqual(self.keys_scanned(), 4)
+
+        self.stream(limit=2)
+        self.assertEqual(self.keys_scanned(), 8)
+
+    def test_page_after_last_key(self):
+        page = json.loads(self.query(after="key-9").body)
+        self.assertEqual(page, {"values": {}, "next": None})
+
+    def test_invalid_page_arguments(self):
+        self.assertEqual(self.query(limit=0).code, 400)
+        self.assertEqual(self.query(limit="1").code, 400)
+        self.assertEqual(self.query(after=1).code, 400)
+
+    def test_stream(self):
+        lines = self.stream()
+        self.assertEqual(lines, [{"key": f"key-{i}", "value": i} for i in range(1, 10)])
+
+    def test_stream_shares_time_budget(self):
+        self._app.settings['query_timeout'] = 0.2
+
+        def slow_query_matches(*args, **kwargs):
+            time.sleep(0.1)
+            return query_matches(*args, **kwargs)
+
+        with unittest.mock.patch("srv.server.query_matches", slow_query_matches):
+            lines = self.stream()
+        # every chunk fits into the time budget on its own, but not all of them together
+        self.assertIn("error", lines[-1])
+        self.assertLess(len(lines), 9)
+
+    def test_stream_with_limit(self):
+        lines = self.stream(limit=4)
+        self.assertEqual(lines[:-1], [{"key": f"key-{i}", "value": i} for i in range(1, 5)])
+        self.assertEqual(lines[-1], {"next": "key-4"})
+
+        lines = self.stream(limit=4, after="key-4")
+        self.assertEqual([line["key"] for line in lines[:-1]], ["key-5", "key-6", "key-7", "key-8"])
+        self.assertEqual(self.stream(limit=4, after=lines[-1]["next"]), [{"key": "key-9", "value": 9}])
+
+
+@pytest.mark.parametrize("expression, conditions", [
+    ("team == 'x'", [(("team",), "x")]),
+    ("`1` == owner.level", [(("owner", "level"), 1)]),
+    ("\"owner.level\" == `1`", [(("owner.level",), 1)]),
+    ("team == 'x' && enabled == `true`", [(("team",), "x"), (("enabled",), True)]),
+    ("team == 'x' || size == `1`", []),
+    ("tags == ['x']", []),
+    ("team != 'x'", []),
+])
+def test_query_conditions(expression, conditions):
+    assert query_conditions(jmespath.compile(expression).parsed) == conditions
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestFieldIndexes(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        values = {"svc-a": {"team": "x", "owner": {"level": 1}}, "svc-b": {"team": "y", "owner": {"level": True}},
+                  "job-a": {"team": "x", "owner": {"level": 1.0}}, "list": [1, 2], "dotted": {"owner.level": 1}}
+        for key, value in values.items():
+            (self.config_values / key).write_text(json.dumps(value))
+        (self.config_values / "broken").write_text("not json")
+        return make_app(self.config_values, index_fields=["team", "owner.level"])
+
+    def post(self, **body):
+        return self.fetch('/config', method='POST', body=json.dumps(body))
+
+    def keys_scanned(self) -> float:
+        metric = self._app.settings['metrics'].query_keys_scanned.collect()[0]
+        return next(sample.value for sample in metric.samples if sample.name.endswith('_sum'))
+
+    def test_query_uses_index(self):
+        response = self.post(query="team == 'x'")
+        self.assertEqual(json.loads(response.body), {"job-a": True, "svc-a": True})
+        self.assertEqual(self.keys_scanned(), 2)
+
+        response = self.post(query="owner.level == `1` && team")
+        self.assertEqual(json.loads(response.body), {"job-a": "x", "svc-a": "x"})
+
+    def test_quoted_field_with_dot(self):
+        response = self.post(query='"owner.level" == `1`')
+        self.assertEqual(json.loads(response.body), {"dotted": True})
+
+    def test_missing_fields_match_null(self):
+        response = self.post(query="team == `null`")
+        self.assertEqual(json.loads(response.body), {"dotted": True, "list": True})
+        self.assertEqual(self.keys_scanned(), 2)
+
+    def test_index_follows_changes(self):
+        self.post(query="team == 'x'")
+        (self.config_values / "svc-b").write_text(json.dumps({"team": "x"}))
+        response = self.post(query="team == 'x'")
+        self.assertEqual(json.loads(response.body), {"job-a": True, "svc-a": True, "svc-b": True})
+
+    def test_paginated_query_uses_index(self):
+        page = json.loads(self.post(query="team == 'x'", limit=1).body)
+        self.assertEqual(page, {"values": {"job-a": True}, "next": "job-a"})
+        page = json.loads(self.post(query="team == 'x'", limit=1, after="job-a").body)
+        self.assertEqual(page, {"values": {"svc-a": True}, "next": None})
+
+    def test_lookup(self):
+        response = self.post(where={"team": "x"})
+        self.assertEqual(json.loads(response.body)["values"], {"job-a": {"team": "x", "owner": {"level": 1.0}},
+                                                               "svc-a": {"team": "x", "owner": {"level": 1}}})
+        response = self.post(where={"owner.level": True})
+        self.assertEqual(list(json.loads(response.body)["values"]), ["svc-b"])
+        response = self.post(where={"team": "x"}, prefix="svc-")
+        self.assertEqual(list(json.loads(response.body)["values"]), ["svc-a"])
+
+    def test_prefix_lookup(self):
+        response = self.post(prefix="svc-")
+        self.assertEqual(list(json.loads(response.body)["values"]), ["svc-a", "svc-b"])
+        response = self.post(prefix="none")
+        self.assertEqual(json.loads(response.body), {"values": {}, "errors": {}})
+
+    def test_invalid_lookup(self):
+        self.assertEqual(self.post(where={"size": 1}).code, 400)
+        self.assertEqual(self.post(where={"team": ["x"]}).code, 400)
+        self.assertEqual(self.post(prefix=1).code, 400)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestConditionalRequests(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        return make_app(self.config_values)
+
+    def test_etag_get(self):
+        response = self.fetch('/config/a')
+        etag = response.headers["Etag"]
+        self.assertEqual(response.code, 200)
+
+        response = self.fetch('/config/a', headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+
+        (self.config_values / "a").write_text(json.dumps({"team": "changed"}))
+        response = self.fetch('/config/a', headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+    def test_etag_query(self):
+        body = json.dumps({"query": "team"})
+        response = self.fetch('/config', method='POST', body=body)
+        etag = response.headers["Etag"]
+
+        response = self.fetch('/config', method='POST', body=body, headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+
+    def test_version(self):
+        response = self.fetch('/config')
+        self.assertEqual(response.code, 200)
+        version = response.headers["X-Config-Version"]
+        self.assertEqual(json.loads(response.body)["version"], version)
+
+        response = self.fetch('/config', method='HEAD', headers={"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(response.code, 304)
+
+        (self.config_values / "b").write_text(json.dumps(1))
+        response = self.fetch('/config', method='HEAD')
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers["X-Config-Version"], version)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestBatch(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        (self.config_values / "b").write_text(json.dumps([1, 2]))
+        (self.config_values / "broken").write_text("not json")
+        return make_app(self.config_values)
+
+    def test_batch_get(self):
+        response = self.fetch('/config?keys=a,b,missing,broken')
+        self.assertEqual(response.code, 200)
+        result = json.loads(response.body)
+        self.assertEqual(result["values"], {"a": {"team": "x"}, "b": [1, 2]})
+        self.assertEqual(result["errors"]["missing"]["status"], 404)
+        self.assertEqual(result["errors"]["broken"]["status"], 400)
+
+        response = self.fetch('/config?keys=a,b,missing,broken', headers={"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(response.code, 304)
+
+    def test_batch_post(self):
+        response = self.fetch('/config', method='POST', body=json.dumps({"keys": ["b", "a/../b"]}))
+        self.assertEqual(response.code, 200)
+        result = json.loads(response.body)
+        self.assertEqual(result["values"], {"b": [1, 2]})
+        self.assertEqual(result["errors"]["a/../b"]["status"], 400)
+
+        response = self.fetch('/config', method='POST', body=json.dumps({"keys": "a"}))
+        self.assertEqual(response.code, 400)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestQueryBudget(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        for i in range(50):
+            (self.config_values / f"key-{i}").write_text(json.dumps({"list": list(range(100))}))
+        return make_app(self.config_values, query_max_bytes=1024)
+
+    def test_result_too_large(self):
+        response = self.fetch('/config', method='POST', body=json.dumps({"query": "list"}))
+        self.assertEqual(response.code, 422)
+
+        response = self.fetch('/config', method='POST', body=json.dumps({"query": "list[1]"}))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.body)), 50)
+
+    def test_time_budget(self):
+        self._app.settings['query_timeout'] = 0
+        response = self.fetch('/config', method='POST', body=json.dumps({"query": "list[-1]"}))
+        self.assertEqual(response.code, 422)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestSubDocument(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "db").write_text(json.dumps({"pool": {"size": 5, "hosts": ["a", "b"]}, "a/b": 1}))
+        return make_app(self.config_values)
+
+    def test_path(self):
+        response = self.fetch('/config/db/pool/size')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), 5)
+
+        response = self.fetch('/config/db/pool/hosts/1')
+        self.assertEqual(json.loads(response.body), "b")
+
+        response = self.fetch('/config/db/a~1b/')
+        self.assertEqual(json.loads(response.body), 1)
+
+        response = self.fetch('/config/db/pool', headers={"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(json.loads(response.body), {"size": 5, "hosts": ["a", "b"]})
+        response = self.fetch('/config/db/pool', headers={"If-None-Match": response.headers["Etag"]})
+        self.assertEqual(response.code, 304)
+
+    def test_path_not_found(self):
+        for path in ('/config/db/missing', '/config/db/pool/size/x', '/config/db/pool/hosts/5',
+                     '/config/db/pool/hosts/-1'):
+            response = self.fetch(path)
+            self.assertEqual(response.code, 404, path)
+
+    def test_path_updated(self):
+        response = self.fetch('/config/db/pool/size')
+        self.assertEqual(json.loads(response.body), 5)
+        (self.config_values / "db").write_text(json.dumps({"pool": {"size": 10}}))
+        response = self.fetch('/config/db/pool/size')
+        self.assertEqual(json.loads(response.body), 10)
@@ -0,0 +1,136 @@
+import json
+import pathlib
+
+import pytest
+import tornado.httpserver
+import tornado.testing
+from tornado.testing import AsyncHTTPTestCase
+
+from srv.server import KubernetesSnapshotStore, make_app
+from tests.fake_apiserver import FakeCluster, make_fake_apiserver
+
+
+@pytest.fixture(scope='function')
+def tmp_path_cls(request, tmp_path):
+    request.cls.config_values = tmp_path
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestKubernetesSource(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        self.cluster = FakeCluster(history=5)
+        self.put_values({"a": {"team": "x"}, "b": {"team": "y"}})
+        sock, port = tornado.testing.bind_unused_port()
+        self.api_server = tornado.httpserver.HTTPServer(make_fake_apiserver(self.cluster))
+        self.api_server.add_sockets([sock])
+
+        self.store = KubernetesSnapshotStore("test-values", "default", f"http://127.0.0.1:{port}")
+        self.store.retry_delay = 0.05
+        self.io_loop.run_sync(self.store.ready)
+        return make_app(self.config_values, store=self.store)
+
+    def tearDown(self):
+        self.store.stop()
+        self.api_server.stop()
+        super().tearDown()
+
+    def put_values(self, values: dict):
+        self.cluster.put("api/v1", "default", "configmaps", {
+            "apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "test-values"},
+            "data": {key: json.dumps(value) for key, value in values.items()},
+        })
+
+    def wait_for(self, generation: int):
+        response = self.fetch(f'/watch?since={generation}&timeout=5')
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def test_initial_list(self):
+        response = self.fetch('/config/a')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"team": "x"})
+        self.assertEqual(self.store.snapshot.generation, int(self.store.resource_versions["test-values"]))
+
+    def test_watch_update(self):
+        generation = self.store.snapshot.generation
+        self.io_loop.call_later(0.1, lambda: self.put_values({"a": {"team": "z"}, "b": {"team": "y"}}))
+
+        changes = self.wait_for(generation)
+        self.assertEqual(changes["changed"], {"a": {"team": "z"}})
+        self.assertEqual(self.store.snapshot.generation, self.cluster.resource_version)
+
+        response = self.fetch('/config/a')
+        self.assertEqual(json.loads(response.body), {"team": "z"})
+
+    def test_unchanged_values_keep_entries(self):
+        entry = self.store.snapshot.entries["b"]
+        generation = self.store.snapshot.generation
+        self.io_loop.call_later(0.1, lambda: self.put_values({"a": {"team": "z"}, "b": {"team": "y"}}))
+
+        self.wait_for(generation)
+        self.assertIs(self.store.snapshot.entries["b"], entry)
+
+    def test_deleted_config_map(self):
+        generation = self.store.snapshot.generation
+        self.io_loop.call_later(0.1, lambda: self.cluster.remove("api/v1", "default", "configmaps", "test-values"))
+
+        changes = self.wait_for(generation)
+        self.assertEqual(changes["deleted"], ["a", "b"])
+        self.assertEqual(self.fetch('/config/a').code, 404)
+
+    def test_relist_after_expired_resource_version(self):
+        self.store.stop()
+        for i in range(10):
+            self.put_values({"a": {"team": i}})
+        generation = self.store.snapshot.generation
+        self.io_loop.run_sync(self.store.current)
+
+        changes = self.wait_for(generation)
+        self.assertEqual(changes["changed"], {"a": {"team": 9}})
+        self.assertEqual(changes["deleted"], ["b"])
+        self.assertEqual(self.store.snapshot.generation, self.cluster.resource_version)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestShardedKubernetesSource(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        self.cluster = FakeCluster()
+        self.put_values("test-values", {"a": 1})
+        self.put_values("test-values-1", {"b": 2})
+        sock, port = tornado.testing.bind_unused_port()
+        self.api_server = tornado.httpserver.HTTPServer(make_fake_apiserver(self.cluster))
+        self.api_server.add_sockets([sock])
+
+        self.store = KubernetesSnapshotStore(["test-values", "test-values-1"], "default", f"http://127.0.0.1:{port}")
+        self.io_loop.run_sync(self.store.ready)
+        return make_app(self.config_values, store=self.store)
+
+    def tearDown(self):
+        self.store.stop()
+        self.api_server.stop()
+        super().tearDown()
+
+    def put_values(self, name: str, values: dict):
+        self.cluster.put("api/v1", "default", "configmaps", {
+            "apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": name},
+            "data": {key: json.dumps(value) for key, value in values.items()},
+        })
+
+    def test_shards_are_merged(self):
+        response = self.fetch('/config/a')
+        self.assertEqual(json.loads(response.body), 1)
+        response = self.fetch('/config/b')
+        self.assertEqual(json.loads(response.body), 2)
+
+    def test_shard_update(self):
+        generation = self.store.snapshot.generation
+        self.io_loop.call_later(0.1, lambda: self.put_values("test-values-1", {"b": 3, "c": 4}))
+
+        response = self.fetch(f'/watch?since={generation}&timeout=5')
+        changes = json.loads(response.body)
+        self.assertEqual(changes["changed"], {"b": 3, "c": 4})
+        self.assertEqual(json.loads(self.fetch('/config/a').body), 1)
@@ -0,0 +1,76 @@
+import json
+import pathlib
+
+import pytest
+import tornado.httpserver
+import tornado.testing
+from prometheus_client.parser import text_string_to_metric_families
+from tornado.testing import AsyncHTTPTestCase
+
+from srv.server import make_app, make_metrics_app
+
+
+@pytest.fixture(scope='function')
+def tmp_path_cls(request, tmp_path):
+    request.cls.config_values = tmp_path
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestMetricsHandler(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        return make_app(self.config_values)
+
+    def samples(self) -> dict:
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        samples = {}
+        for family in text_string_to_metric_families(response.body.decode()):
+            for sample in family.samples:
+                samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+        return samples
+
+    def test_metrics(self):
+        self.fetch('/config/a')
+        self.fetch('/config/missing')
+        self.fetch('/config', method='POST', body=json.dumps({"query": "team"}))
+        self.fetch('/config', method='POST', body=json.dumps({"query": "team"}))
+
+        samples = self.samples()
+        self.assertEqual(samples[('config_server_responses_total',
+                                  (('code', '200'), ('method', 'GET'), ('route', 'config')))], 1)
+        self.assertEqual(samples[('config_server_responses_total',
+                                  (('code', '404'), ('method', 'GET'), ('route', 'config')))], 1)
+        self.assertEqual(samples[('config_server_request_duration_seconds_count',
+                                  (('method', 'POST'), ('route', 'config')))], 2)
+        self.assertGreater(samples[('config_server_response_bytes_total', (('route', 'config'),))], 0)
+        self.assertEqual(samples[('config_server_query_keys_scanned_count', ())], 1)
+        self.assertEqual(samples[('config_server_cache_lookups_total', (('cache', 'query'), ('result', 'hit')))], 1)
+        self.assertEqual(samples[('config_server_cache_lookups_total', (('cache', 'query'), ('result', 'miss')))], 1)
+        self.assertEqual(samples[('config_server_snapshot_keys', ())], 1)
+        self.assertEqual(samples[('config_server_snapshot_generation', ())], 1)
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestWorkerMetrics(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        return make_app(self.config_values, metrics_route=False)
+
+    def test_metrics_on_own_port(self):
+        self.fetch('/config/a')
+        self.assertEqual(self.fetch('/metrics').code, 404)
+
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(make_metrics_app(self._app.settings['metrics']))
+        server.add_sockets([sock])
+        try:
+            response = self.fetch(f'http://127.0.0.1:{port}/metrics')
+        finally:
+            server.stop()
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'config_server_responses_total{code="200",method="GET",route="config"} 1.0', response.body)
@@ -0,0 +1,62 @@
+import json
+import pathlib
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from srv.server import make_app, SharedSnapshotStore, load_snapshot, serialize_snapshot, map_snapshot
+
+
+@pytest.fixture(scope='function')
+def tmp_path_cls(request, tmp_path):
+    request.cls.config_values = tmp_path / "config"
+    request.cls.config_values.mkdir()
+    request.cls.snapshot_dir = tmp_path / "snapshots"
+
+
+def test_serialize_round_trip(tmp_path):
+    (tmp_path / "a").write_text(json.dumps({"foo": "bar"}))
+    (tmp_path / "b").write_text(json.dumps([1, "ü"]))
+    (tmp_path / "broken").write_text("not json")
+    snapshot = load_snapshot(tmp_path, generation=7)
+
+    mapped = map_snapshot(serialize_snapshot(snapshot))
+    assert mapped.generation == 7
+    assert mapped.version == snapshot.version
+    assert mapped.entries.keys() == snapshot.entries.keys()
+    for key in ("a", "b"):
+        assert mapped.entries[key].body == snapshot.entries[key].body
+        assert mapped.entries[key].etag == snapshot.entries[key].etag
+        assert mapped.entries[key].value == snapshot.entries[key].value
+    assert mapped.entries["broken"].error == snapshot.entries["broken"].error
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestSharedSnapshot(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+    snapshot_dir: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"foo": "bar"}))
+        return make_app(self.config_values, snapshot_dir=self.snapshot_dir)
+
+    def test_get(self):
+        response = self.fetch('/config/a')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"foo": "bar"})
+
+        response = self.fetch('/config', method='POST', body=json.dumps({"query": "foo"}))
+        self.assertEqual(json.loads(response.body), {"a": "bar"})
+
+    def test_workers_share_file(self):
+        store = self._app.settings['config_store']
+        other = SharedSnapshotStore(self.config_values, self.snapshot_dir)
+        self.assertEqual(other.snapshot.generation, store.snapshot.generation)
+        self.assertEqual(len(list(store.snapshot_dir.glob("snapshot-*.bin"))), 1)
+
+        (self.config_values / "b").write_text(json.dumps(1))
+        other.refresh()
+        response = self.fetch('/config/b')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(store.snapshot.generation, other.snapshot.generation)
+        self.assertEqual(len(list(store.snapshot_dir.glob("snapshot-*.bin"))), 2)
@@ -0,0 +1,105 @@
+import json
+import pathlib
+import time
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from srv.server import make_app
+
+
+@pytest.fixture(scope='function')
+def tmp_path_cls(request, tmp_path):
+    request.cls.config_values = tmp_path
+
+
+@pytest.mark.usefixtures("tmp_path_cls")
+class TestWatchHandler(AsyncHTTPTestCase):
+    config_values: pathlib.Path
+
+    def get_app(self):
+        (self.config_values / "a").write_text(json.dumps({"team": "x"}))
+        (self.config_values / "b").write_text(json.dumps({"team": "y"}))
+        return make_app(self.config_values)
+
+    @property
+    def generation(self) -> int:
+        return self._app.settings['config_store'].snapshot.generation
+
+    def write_later(self, key: str, value):
+        self.io_loop.call_later(0.2, lambda: (self.config_values / key).write_text(json.dumps(value)))
+
+    def test_resync(self):
+        response = self.fetch('/watch?since=0')
+        self.assertEqual(response.code, 200)
+        changes = json.loads(response.body)
+        self.assertTrue(changes["resync"])
+        self.assertEqual(changes["changed"], {"a": {"team": "x"}, "b": {"team": "y"}})
+
+    def test_long_poll(self):
+        generation = self.generation
+        self.write_later("a", {"team": "z"})
+
+        response = self.fetch(f'/watch?since={generation}&timeout=5')
+        self.assertEqual(response.code, 200)
+        changes = json.loads(response.body)
+        self.assertFalse(changes["resync"])
+        self.assertEqual(changes["generation"], generation + 1)
+        self.assertEqual(changes["changed"], {"a": {"team": "z"}})
+        self.assertEqual(changes["deleted"], [])
+
+    def test_long_poll_timeout(self):
+        response = self.fetch(f'/watch?since={self.generation}&timeout=0.3')
+        self.assertEqual(response.code, 304)
+
+    def test_long_poll_key_filter(self):
+        generation = self.generation
+        self.write_later("a", {"team": "z"})
+        response = self.fetch(f'/watch?since={generation}&keys=b&timeout=0.6')
+        self.assertEqual(response.code, 304)
+
+    def test_query_watch(self):
+        response = self.fetch('/watch?query=team')
+        self.assertEqual(json.loads(response.body), {"a": "x", "b": "y"})
+        etag = response.headers["Etag"]
+
+        self.write_later("b", {"team": "z"})
+        response = self.fetch('/watch?query=team&timeout=5', headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"a": "x", "b": "z"})
+
+    def test_compressed_query_watch(self):
+        (self.config_values / "c").write_text(json.dumps({"team": "x" * 4096}))
+        response = self.fetch('/watch?query=team', headers={"Accept-Encoding": "gzip"})
+        etag = response.headers["Etag"]
+        self.assertTrue(etag.endswith('-json.gzip"'))
+
+        started = time.monotonic()
+        response = self.fetch('/watch?query=team&timeout=0.5',
+                              headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+
+        self.write_later("b", {"team": "z"})
+        response = self.fetch('/watch?query=team&timeout=5', headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["b"], "z")
+
+    def test_event_stream(self):
+        events = []
+
+        def on_chunk(chunk: bytes):
+            events.append(chunk)
+            if len(events) == 2:
+                self.stop()
+
+        self.write_later("c", [1])
+        self.http_client.fetch(self.get_url(f'/watch?since={self.generation - 1}'),
+                               headers={"Accept": "text/event-stream"},
+                               streaming_callback=on_chunk, request_timeout=5, raise_error=False)
+        self.wait(timeout=5)
+
+        for event in events:
+            self.assertTrue(event.startswith(b"id: "))
+        second = json.loads(events[1].split(b"data: ", 1)[1])
+        self.assertEqual(second["changed"], {"c": [1]})